@@ -1,5 +1,5 @@
 # app.py - Flask Web Application
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for
+from flask import Flask, Response, render_template, request, jsonify, send_file, redirect, url_for, stream_with_context
 import os
 import re
 import json
@@ -8,11 +8,35 @@ import yt_dlp
 import subprocess
 import tempfile
 import uuid
+import random
+import urllib.parse
+import io
+import zipfile
+import shutil
+import hashlib
+import selectors
+import cProfile
+import pstats
+import socket
+import itertools
 import threading
-from datetime import datetime
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from pathlib import Path
+from werkzeug.datastructures import Range
 from werkzeug.utils import secure_filename
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import ClosingIterator
 from dotenv import load_dotenv
+from prometheus_client import (CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST,
+                               generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import (create_engine, event, MetaData, Table, Column, Index, String,
+                        Integer, Float, Text, select, insert, update, delete, func, and_, or_, inspect)
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.pool import StaticPool
 os.environ["PATH"] += os.pathsep + "/usr/bin"  # Tambahkan path FFmpeg jika diperlukan
 
 load_dotenv() # Muat variabel dari file .env
@@ -22,14 +46,1342 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'a-default-secret-key-fo
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
 app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
 app.config['ALLOWED_EXTENSIONS'] = {'txt'}
+# Job dan riwayat disimpan di database agar bisa dibagi antar worker gunicorn
+app.config['DATABASE_URL'] = os.environ.get('DATABASE_URL', 'sqlite:///downloads.db')
+# Cache info video: TTL dalam detik dan jumlah entri di memori tiap worker
+app.config['METADATA_CACHE_TTL'] = int(os.environ.get('METADATA_CACHE_TTL', 3600))
+app.config['METADATA_CACHE_SIZE'] = int(os.environ.get('METADATA_CACHE_SIZE', 1024))
+# Info lengkap (termasuk URL stream) dari /api/video-info disimpan sebentar untuk /api/download
+app.config['INFO_CACHE_TTL'] = int(os.environ.get('INFO_CACHE_TTL', 600))
+# File hasil yang sudah jadi dipakai ulang untuk permintaan (URL, format) yang sama
+app.config['CACHE_FOLDER'] = os.environ.get('CACHE_FOLDER', os.path.join(tempfile.gettempdir(), 'media-cache'))
+app.config['OUTPUT_CACHE_MAX_BYTES'] = int(os.environ.get('OUTPUT_CACHE_MAX_BYTES', 10 * 1024**3))
+# File hasil dihapus setelah tidak diakses selama OUTPUT_CACHE_TTL detik
+app.config['OUTPUT_CACHE_TTL'] = int(os.environ.get('OUTPUT_CACHE_TTL', 86400))
+# Jika disk terisi di atas HIGH, file lama dihapus sampai pemakaian turun ke LOW
+app.config['DISK_HIGH_WATERMARK'] = float(os.environ.get('DISK_HIGH_WATERMARK', 0.90))
+app.config['DISK_LOW_WATERMARK'] = float(os.environ.get('DISK_LOW_WATERMARK', 0.85))
+# Interval (detik) pembersihan cache, riwayat dan folder kerja
+app.config['STORAGE_SWEEP_INTERVAL'] = int(os.environ.get('STORAGE_SWEEP_INTERVAL', 300))
+# Folder kerja per job untuk stream mentah sebelum diproses FFmpeg
+app.config['WORK_FOLDER'] = os.environ.get('WORK_FOLDER', os.path.join(tempfile.gettempdir(), 'media-work'))
+# Batas proses paralel: unduhan jaringan dan transcode FFmpeg dibatasi terpisah
+app.config['FETCH_WORKERS'] = int(os.environ.get('FETCH_WORKERS', 4))
+app.config['TRANSCODE_WORKERS'] = int(os.environ.get('TRANSCODE_WORKERS', os.cpu_count() or 2))
+# Jurnal job: interval heartbeat worker dan lama diam (detik) sebelum job-nya diambil alih worker lain
+app.config['JOB_HEARTBEAT_INTERVAL'] = int(os.environ.get('JOB_HEARTBEAT_INTERVAL', 15))
+app.config['JOB_LEASE_TIMEOUT'] = int(os.environ.get('JOB_LEASE_TIMEOUT', 60))
+# Koneksi event stream ditutup berkala; browser menyambung ulang dengan Last-Event-ID
+app.config['EVENT_STREAM_MAX_SECONDS'] = int(os.environ.get('EVENT_STREAM_MAX_SECONDS', 300))
+# Tiap event stream memakai satu thread gunicorn selama terbuka. Di atas batas ini (per worker)
+# dijawab 503 dan browser beralih ke polling /api/status; sisakan thread untuk request lain
+app.config['EVENT_STREAM_MAX_CONNECTIONS'] = int(os.environ.get('EVENT_STREAM_MAX_CONNECTIONS', 8))
+# Lama /api/stream menunggu slot transcode kosong sebelum menjawab 503
+app.config['STREAM_SLOT_TIMEOUT'] = float(os.environ.get('STREAM_SLOT_TIMEOUT', 10))
+# Jumlah item satu batch yang boleh menunggu/berjalan di antrean sekaligus
+app.config['BATCH_QUEUE_WINDOW'] = int(os.environ.get('BATCH_QUEUE_WINDOW', 8))
+# Jumlah instance YoutubeDL menganggur yang disimpan per profil opsi
+app.config['YDL_POOL_SIZE'] = int(os.environ.get('YDL_POOL_SIZE', 8))
+# Ekstraksi info video berjalan di pool terpisah; request hanya menunggu hasilnya
+app.config['EXTRACT_WORKERS'] = int(os.environ.get('EXTRACT_WORKERS', 32))
+app.config['EXTRACT_MAX_PENDING'] = int(os.environ.get('EXTRACT_MAX_PENDING', 256))
+app.config['VIDEO_INFO_TIMEOUT'] = float(os.environ.get('VIDEO_INFO_TIMEOUT', 20))
+app.config['BULK_INFO_MAX_URLS'] = int(os.environ.get('BULK_INFO_MAX_URLS', 100))
+# Batas lalu lintas keluar per host: request/detik, burst, dan total koneksi fragmen
+app.config['HOST_REQUEST_RATE'] = float(os.environ.get('HOST_REQUEST_RATE', 10))
+app.config['HOST_REQUEST_BURST'] = int(os.environ.get('HOST_REQUEST_BURST', 20))
+app.config['HOST_MAX_CONNECTIONS'] = int(os.environ.get('HOST_MAX_CONNECTIONS', 16))
+# Batas per klien (IP): unduhan aktif, unduhan baru per menit, batch berjalan, byte per 24 jam (0 = tanpa batas)
+app.config['CLIENT_MAX_ACTIVE_JOBS'] = int(os.environ.get('CLIENT_MAX_ACTIVE_JOBS', 3))
+app.config['CLIENT_JOBS_PER_MINUTE'] = int(os.environ.get('CLIENT_JOBS_PER_MINUTE', 10))
+app.config['CLIENT_MAX_BATCHES'] = int(os.environ.get('CLIENT_MAX_BATCHES', 1))
+app.config['CLIENT_DAILY_BYTES'] = int(os.environ.get('CLIENT_DAILY_BYTES', 0))
+# Pengiriman file: '' (sendfile dari gunicorn), 'x-accel' (nginx) atau 'x-sendfile' (Apache/lighttpd)
+app.config['SENDFILE_MODE'] = os.environ.get('SENDFILE_MODE', '').lower()
+# Lokasi internal nginx yang menunjuk ke CACHE_FOLDER untuk mode x-accel
+app.config['X_ACCEL_PREFIX'] = os.environ.get('X_ACCEL_PREFIX', '/protected-media/')
+app.config['USE_X_SENDFILE'] = app.config['SENDFILE_MODE'] == 'x-sendfile'
+# Prefetch spekulatif (default nonaktif): setelah /api/video-info berhasil, audio terbaik langsung
+# diunduh ke folder staging supaya /api/download format audio cukup mengonversi file tersebut
+app.config['PREFETCH_ENABLED'] = os.environ.get('PREFETCH_ENABLED', '').lower() in ('1', 'true', 'yes')
+app.config['PREFETCH_FOLDER'] = os.environ.get('PREFETCH_FOLDER', os.path.join(tempfile.gettempdir(), 'media-prefetch'))
+app.config['PREFETCH_MAX_BYTES'] = int(os.environ.get('PREFETCH_MAX_BYTES', 2 * 1024**3))
+app.config['PREFETCH_MAX_FILE_BYTES'] = int(os.environ.get('PREFETCH_MAX_FILE_BYTES', 200 * 1024**2))
+# Lama (detik) file staging disimpan, dan lama /api/download menunggu prefetch yang sedang berjalan
+app.config['PREFETCH_TTL'] = int(os.environ.get('PREFETCH_TTL', 300))
+app.config['PREFETCH_WAIT'] = float(os.environ.get('PREFETCH_WAIT', 60))
 
+# Profiling per job: kirim header X-Profile-Key dengan nilai ini ke /api/download (kosong = nonaktif)
+app.config['PROFILE_KEY'] = os.environ.get('PROFILE_KEY', '')
+app.config['PROFILE_FOLDER'] = os.environ.get('PROFILE_FOLDER', os.path.join(tempfile.gettempdir(), 'media-profiles'))
+
+# Job priorities (lower value runs first)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+PRIORITY_PREFETCH = 20  # speculative; preempted as soon as regular jobs need its fetch slot
+
+# Metrik Prometheus. Di gunicorn nilainya digabung antarworker lewat PROMETHEUS_MULTIPROC_DIR
+STAGE_SECONDS = Histogram(
+    'downloader_stage_seconds', 'Duration of extract, download, postprocess and serve stages',
+    ['stage', 'format_key', 'extractor'],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800))
+DOWNLOAD_BYTES = Counter('downloader_download_bytes', 'Bytes fetched from sources',
+                         ['format_key', 'extractor'])
+DOWNLOAD_SPEED = Histogram(
+    'downloader_download_speed_bytes_per_second', 'Source download throughput of each job', ['extractor'],
+    buckets=(64 * 1024, 256 * 1024, 1024**2, 4 * 1024**2, 16 * 1024**2, 64 * 1024**2, 256 * 1024**2))
+QUEUE_WAIT = Histogram('downloader_queue_wait_seconds', 'Time a job waited for a fetch slot', ['priority'],
+                       buckets=(0.01, 0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600))
+CACHE_LOOKUPS = Counter('downloader_cache_lookups', 'Cache lookups by result', ['cache', 'result'])
+FFMPEG_CPU = Counter('downloader_ffmpeg_cpu_seconds', 'CPU time used by FFmpeg processes', ['pipeline'])
+ERRORS = Counter('downloader_errors', 'Failed jobs by stage and exception type', ['stage', 'type'])
+
+def priority_label(priority):
+    return 'interactive' if priority <= PRIORITY_INTERACTIVE else 'batch'
+
+def job_metric_labels(job):
+    """(format_key, extractor) labels of a job; the extractor is the prefix of its cache key"""
+    return job['format_key'], (job.get('cache_key') or 'unknown:').split(':', 1)[0]
+
+
+class JobStore:
+    """Job state and download history shared by every worker process.
+
+    Backed by any SQLAlchemy URL; SQLite runs in WAL mode so readers in other
+    workers are not blocked by the writer.
+    """
+
+    # Kolom yang sering diperbarui; field lain disimpan sebagai JSON di kolom `data`
+    COLUMNS = ('status', 'progress', 'message', 'attached_to', 'stage')
+
+    def __init__(self, url):
+        self.metadata = MetaData()
+        self.jobs = Table(
+            'jobs', self.metadata,
+            Column('job_id', String(36), primary_key=True),
+            Column('user_ip', String(64), nullable=False),
+            Column('url', Text, nullable=False),
+            Column('format_key', String(16), nullable=False),
+            Column('priority', Integer, nullable=False, default=0),
+            Column('status', String(16), nullable=False),
+            Column('progress', Float, nullable=False, default=0),
+            Column('message', Text, nullable=False, default=''),
+            Column('data', Text, nullable=False, default='{}'),
+            # Job yang benar-benar mengunduh file ini (bisa job lain dengan URL & format sama)
+            Column('attached_to', String(36), nullable=True, index=True),
+            Column('batch_id', String(36), nullable=True, index=True),
+            # URL kanonik + format; dipakai untuk menggabungkan permintaan ganda dari klien yang sama
+            Column('cache_key', String(255), nullable=True),
+            # Jurnal: tahap terakhir (extracting, downloading, postprocessing, done) dan worker pemiliknya
+            Column('stage', String(16), nullable=True),
+            Column('owner', String(128), nullable=True),
+            Column('created_at', Float, nullable=False),
+            Column('updated_at', Float, nullable=False),
+            Index('ix_jobs_status_priority', 'status', 'priority', 'created_at'),
+            Index('ix_jobs_user_ip_updated', 'user_ip', 'updated_at'),
+            Index('ix_jobs_user_ip_created', 'user_ip', 'created_at'),
+            Index('ix_jobs_user_ip_cache_key', 'user_ip', 'cache_key'),
+        )
+        self.history = Table(
+            'history', self.metadata,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('job_id', String(36), nullable=False, index=True),
+            Column('user_ip', String(64), nullable=False),
+            Column('url', Text, nullable=False),
+            Column('title', Text, nullable=False),
+            Column('quality', String(64), nullable=False),
+            Column('timestamp', String(32), nullable=False, index=True),
+            Column('filesize', Integer, nullable=False, default=0),
+            Index('ix_history_user_ip_timestamp', 'user_ip', 'timestamp'),
+        )
+        self.batches = Table(
+            'batches', self.metadata,
+            Column('batch_id', String(36), primary_key=True),
+            Column('user_ip', String(64), nullable=False),
+            Column('format_key', String(16), nullable=False),
+            # expanding: URL masih dibaca/diantrekan, expanded: semua item sudah jadi job
+            Column('status', String(16), nullable=False),
+            Column('source_path', Text, nullable=False),
+            Column('total', Integer, nullable=False, default=0),
+            Column('message', Text, nullable=False, default=''),
+            Column('owner', String(128), nullable=True),
+            Column('created_at', Float, nullable=False),
+            Column('updated_at', Float, nullable=False),
+        )
+        # Heartbeat tiap proses worker; job milik worker yang diam diambil alih
+        self.workers = Table(
+            'workers', self.metadata,
+            Column('worker_id', String(128), primary_key=True),
+            Column('heartbeat_at', Float, nullable=False, index=True),
+        )
+        self.engine = self._create_engine(url)
+        self._write_lock = threading.Lock()
+        # Dibangunkan setiap kali job berubah di proses ini (untuk event stream)
+        self.changed = threading.Condition()
+        self._worker = (None, None)
+        self.create_tables(self.metadata)
+
+    def create_tables(self, metadata):
+        try:
+            metadata.create_all(self.engine)
+        except OperationalError:
+            # Worker lain sedang membuat tabel yang sama
+            time.sleep(0.5)
+            metadata.create_all(self.engine)
+        self._add_missing_columns(metadata)
+
+    def _add_missing_columns(self, metadata):
+        """Add columns/indexes introduced after a database file was created"""
+        inspector = inspect(self.engine)
+        for table in metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            missing = [column for column in table.columns if column.name not in existing]
+            if not missing:
+                continue
+            with self.engine.begin() as conn:
+                for column in missing:
+                    column_type = column.type.compile(dialect=self.engine.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+            for index in table.indexes:
+                index.create(self.engine, checkfirst=True)
+
+    @property
+    def worker_id(self):
+        """Identity of this process in the job journal; a forked worker gets its own"""
+        if self._worker[0] != os.getpid():
+            self._worker = (os.getpid(), f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}')
+        return self._worker[1]
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction, serialized within the process (SQLite has a single writer)"""
+        with self._write_lock, self.engine.begin() as conn:
+            yield conn
+
+    @staticmethod
+    def _create_engine(url):
+        if not url.startswith('sqlite'):
+            return create_engine(url, pool_pre_ping=True)
+        
+        if url in ('sqlite://', 'sqlite:///:memory:'):
+            engine = create_engine(url, poolclass=StaticPool,
+                                   connect_args={'check_same_thread': False})
+        else:
+            engine = create_engine(url, connect_args={'check_same_thread': False, 'timeout': 30})
+        
+        @event.listens_for(engine, 'connect')
+        def _sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute('PRAGMA busy_timeout=30000')
+            cursor.close()
+        
+        return engine
+
+    def _job_to_dict(self, row):
+        job = json.loads(row.data)
+        job.update({
+            'job_id': row.job_id,
+            'status': row.status,
+            'progress': row.progress,
+            'message': row.message,
+            'url': row.url,
+            'format_key': row.format_key,
+            'user_ip': row.user_ip,
+            'priority': row.priority,
+            'created_at': row.created_at,
+            'updated_at': row.updated_at,
+            'attached_to': row.attached_to,
+            'batch_id': row.batch_id,
+            'stage': row.stage,
+            'owner': row.owner,
+        })
+        if row.cache_key:
+            job['cache_key'] = row.cache_key
+        return job
+
+    def create_job(self, job_id, url, format_key, user_ip, priority=0, attached_to=None,
+                   batch_id=None, cache_key=None, **fields):
+        """Insert a new job in 'queued' state"""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(insert(self.jobs).values(
+                job_id=job_id, user_ip=user_ip, url=url, format_key=format_key,
+                priority=priority, status='queued', progress=0,
+                message=fields.pop('message', ''), data=json.dumps(fields),
+                attached_to=attached_to, batch_id=batch_id, cache_key=cache_key,
+                owner=self.worker_id, created_at=now, updated_at=now,
+            ))
+        self._notify()
+
+    def get_job(self, job_id):
+        with self.engine.connect() as conn:
+            row = conn.execute(select(self.jobs).where(self.jobs.c.job_id == job_id)).first()
+        return self._job_to_dict(row) if row else None
+
+    def update_job(self, job_id, **fields):
+        """Update a job; unknown keys are merged into its JSON data"""
+        values = {key: fields.pop(key) for key in self.COLUMNS if key in fields}
+        values['updated_at'] = time.time()
+        with self.transaction() as conn:
+            if fields:
+                row = conn.execute(select(self.jobs.c.data)
+                                   .where(self.jobs.c.job_id == job_id)).first()
+                if row is None:
+                    return
+                data = json.loads(row.data)
+                data.update(fields)
+                values['data'] = json.dumps(data)
+            conn.execute(update(self.jobs).where(self.jobs.c.job_id == job_id).values(**values))
+        self._notify()
+
+    def update_build(self, build_id, status=None, progress=None, message=None, stage=None):
+        """Update status columns of every active job attached to one download"""
+        values = {key: value for key, value in
+                  (('status', status), ('progress', progress), ('message', message), ('stage', stage))
+                  if value is not None}
+        values['updated_at'] = time.time()
+        with self.transaction() as conn:
+            conn.execute(update(self.jobs)
+                         .where(self.jobs.c.attached_to == build_id,
+                                self.jobs.c.status.in_(('queued', 'processing')))
+                         .values(**values))
+        self._notify()
+
+    def attached_jobs(self, build_id):
+        """Queued or running jobs waiting for one download. A cancelled job keeps its
+        attached_to (the build job too), so the download stays findable for the others"""
+        c = self.jobs.c
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(self.jobs).where(c.attached_to == build_id,
+                                                        c.status.in_(('queued', 'processing')))).all()
+        return [self._job_to_dict(row) for row in rows]
+
+    def _notify(self):
+        with self.changed:
+            self.changed.notify_all()
+
+    def wait_for_change(self, timeout):
+        """Block until a job changes in this process or the timeout passes"""
+        with self.changed:
+            self.changed.wait(timeout)
+
+    def jobs_updated_since(self, user_ip, since):
+        """Jobs of one client updated after the given unix time"""
+        query = (select(self.jobs)
+                 .where(self.jobs.c.user_ip == user_ip, self.jobs.c.updated_at > since)
+                 .order_by(self.jobs.c.updated_at))
+        with self.engine.connect() as conn:
+            return [self._job_to_dict(row) for row in conn.execute(query)]
+
+    def count_jobs(self, status):
+        with self.engine.connect() as conn:
+            return conn.execute(select(func.count()).select_from(self.jobs)
+                                .where(self.jobs.c.status == status)).scalar()
+
+    def active_job_counts(self):
+        """(status, priority, count, oldest created_at) of queued and running jobs"""
+        c = self.jobs.c
+        query = (select(c.status, c.priority, func.count(), func.min(c.created_at))
+                 .where(c.status.in_(('queued', 'processing')))
+                 .group_by(c.status, c.priority))
+        with self.engine.connect() as conn:
+            return conn.execute(query).all()
+
+    def queue_position(self, job_id):
+        """1-based position of a queued job among all queued jobs"""
+        job = self.get_job(job_id)
+        if not job or job['status'] != 'queued':
+            return None
+        c = self.jobs.c
+        ahead = and_(c.status == 'queued', or_(
+            c.priority < job['priority'],
+            and_(c.priority == job['priority'], c.created_at < job['created_at']),
+        ))
+        with self.engine.connect() as conn:
+            return conn.execute(select(func.count()).select_from(self.jobs).where(ahead)).scalar() + 1
+
+    def find_active_job(self, user_ip, cache_key):
+        """A queued or running interactive job of one client for the same output"""
+        c = self.jobs.c
+        query = (select(self.jobs)
+                 .where(c.user_ip == user_ip, c.cache_key == cache_key, c.batch_id.is_(None),
+                        c.status.in_(('queued', 'processing')))
+                 .order_by(c.created_at).limit(1))
+        with self.engine.connect() as conn:
+            row = conn.execute(query).first()
+        return self._job_to_dict(row) if row else None
+
+    def count_active_jobs(self, user_ip):
+        """Interactive jobs of one client that are queued or running"""
+        c = self.jobs.c
+        query = (select(func.count()).select_from(self.jobs)
+                 .where(c.user_ip == user_ip, c.batch_id.is_(None),
+                        c.status.in_(('queued', 'processing'))))
+        with self.engine.connect() as conn:
+            return conn.execute(query).scalar()
+
+    def jobs_created_since(self, user_ip, since):
+        """(count, oldest created_at) of interactive jobs one client started after `since`"""
+        c = self.jobs.c
+        query = (select(func.count(), func.min(c.created_at))
+                 .where(c.user_ip == user_ip, c.batch_id.is_(None), c.created_at > since))
+        with self.engine.connect() as conn:
+            return tuple(conn.execute(query).one())
+
+    def count_active_batches(self, user_ip):
+        """Batches of one client that are still being expanded"""
+        query = (select(func.count()).select_from(self.batches)
+                 .where(self.batches.c.user_ip == user_ip, self.batches.c.status == 'expanding'))
+        with self.engine.connect() as conn:
+            return conn.execute(query).scalar()
+
+    def bytes_downloaded_since(self, user_ip, since):
+        """(total filesize, oldest ISO timestamp) of one client's history after `since`"""
+        h = self.history.c
+        query = (select(func.coalesce(func.sum(h.filesize), 0), func.min(h.timestamp))
+                 .where(h.user_ip == user_ip, h.timestamp > since))
+        with self.engine.connect() as conn:
+            return tuple(conn.execute(query).one())
+
+    def create_batch(self, batch_id, user_ip, format_key, source_path):
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(insert(self.batches).values(
+                batch_id=batch_id, user_ip=user_ip, format_key=format_key, status='expanding',
+                source_path=source_path, total=0, message='', owner=self.worker_id,
+                created_at=now, updated_at=now,
+            ))
+
+    def get_batch(self, batch_id):
+        with self.engine.connect() as conn:
+            row = conn.execute(select(self.batches).where(self.batches.c.batch_id == batch_id)).first()
+        return dict(row._mapping) if row else None
+
+    def update_batch(self, batch_id, **values):
+        values['updated_at'] = time.time()
+        with self.transaction() as conn:
+            conn.execute(update(self.batches).where(self.batches.c.batch_id == batch_id).values(**values))
+        self._notify()
+
+    def batch_counts(self, batch_id):
+        """Number of jobs of a batch per status"""
+        query = (select(self.jobs.c.status, func.count()).where(self.jobs.c.batch_id == batch_id)
+                 .group_by(self.jobs.c.status))
+        with self.engine.connect() as conn:
+            return dict(conn.execute(query).all())
+
+    def batch_jobs(self, batch_id, since=0):
+        """Jobs of a batch updated after the given unix time, in queue order"""
+        query = (select(self.jobs)
+                 .where(self.jobs.c.batch_id == batch_id, self.jobs.c.updated_at > since)
+                 .order_by(self.jobs.c.created_at))
+        with self.engine.connect() as conn:
+            return [self._job_to_dict(row) for row in conn.execute(query)]
+
+    def heartbeat(self):
+        """Mark this worker alive and forget workers silent for a day"""
+        now = time.time()
+        with self.transaction() as conn:
+            result = conn.execute(update(self.workers).where(self.workers.c.worker_id == self.worker_id)
+                                  .values(heartbeat_at=now))
+            if not result.rowcount:
+                conn.execute(insert(self.workers).values(worker_id=self.worker_id, heartbeat_at=now))
+            conn.execute(delete(self.workers).where(self.workers.c.heartbeat_at < now - 86400))
+
+    def retire_worker(self):
+        """Drop this worker's heartbeat so others take over its jobs right away"""
+        with self.transaction() as conn:
+            conn.execute(delete(self.workers).where(self.workers.c.worker_id == self.worker_id))
+
+    def _live_workers(self, timeout):
+        return select(self.workers.c.worker_id).where(self.workers.c.heartbeat_at > time.time() - timeout)
+
+    def orphaned_builds(self, timeout):
+        """Unfinished downloads whose worker stopped sending heartbeats. A download
+        is unfinished while any job attached to it is, even if its build job was cancelled"""
+        c = self.jobs.c
+        waiting = self.jobs.alias('waiting')
+        active_builds = select(waiting.c.attached_to).where(waiting.c.status.in_(('queued', 'processing')))
+        query = (select(self.jobs)
+                 .where(c.job_id.in_(active_builds), c.attached_to == c.job_id,
+                        or_(c.owner.is_(None), c.owner.not_in(self._live_workers(timeout))))
+                 .order_by(c.priority, c.created_at))
+        with self.engine.connect() as conn:
+            return [self._job_to_dict(row) for row in conn.execute(query)]
+
+    def orphaned_batches(self, timeout):
+        """Batches still being expanded by a worker that stopped sending heartbeats"""
+        c = self.batches.c
+        query = (select(self.batches)
+                 .where(c.status == 'expanding',
+                        or_(c.owner.is_(None), c.owner.not_in(self._live_workers(timeout))))
+                 .order_by(c.created_at))
+        with self.engine.connect() as conn:
+            return [dict(row._mapping) for row in conn.execute(query)]
+
+    def take_over(self, table, key, previous_owner):
+        """Move one job/batch row to this worker; False if another worker got it first"""
+        key_column = table.primary_key.columns.values()[0]
+        owner = table.c.owner
+        with self.transaction() as conn:
+            result = conn.execute(update(table)
+                                  .where(key_column == key,
+                                         owner.is_(None) if previous_owner is None else owner == previous_owner)
+                                  .values(owner=self.worker_id))
+        return result.rowcount == 1
+
+    def add_history(self, **entry):
+        with self.transaction() as conn:
+            conn.execute(insert(self.history).values(**entry))
+
+    def recent_history(self, limit, user_ip=None):
+        """Latest history entries, oldest first"""
+        query = select(self.history).order_by(self.history.c.timestamp.desc()).limit(limit)
+        if user_ip is not None:
+            query = query.where(self.history.c.user_ip == user_ip)
+        with self.engine.connect() as conn:
+            rows = conn.execute(query).mappings().all()
+        return [{key: value for key, value in row.items() if key != 'id'} for row in reversed(rows)]
+
+    def clear_history(self, user_ip):
+        with self.transaction() as conn:
+            conn.execute(delete(self.history).where(self.history.c.user_ip == user_ip))
+
+    def purge_history(self, before):
+        """Remove history entries with an ISO timestamp older than `before`"""
+        with self.transaction() as conn:
+            conn.execute(delete(self.history).where(self.history.c.timestamp < before))
+
+    def count_history(self):
+        with self.engine.connect() as conn:
+            return conn.execute(select(func.count()).select_from(self.history)).scalar()
+
+
+store = JobStore(app.config['DATABASE_URL'])
+
+class MetadataCache:
+    """TTL + LRU cache for extracted metadata with single-flight loading.
+
+    A small in-process LRU sits in front of a table shared by all workers.
+    Concurrent misses for the same key wait for one loader call.
+    """
+
+    def __init__(self, store, table_name, ttl, max_entries):
+        self.store = store
+        self.engine = store.engine
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.metadata = MetaData()
+        self.table = Table(
+            table_name, self.metadata,
+            Column('key', String(255), primary_key=True),
+            Column('value', Text, nullable=False),
+            Column('expires_at', Float, nullable=False, index=True),
+        )
+        store.create_tables(self.metadata)
+        self._local = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> [threading.Event, value]
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0}
+
+    def count(self, result):
+        self.stats[result] += 1
+        CACHE_LOOKUPS.labels(self.table.name, result).inc()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._local.get(key)
+            if entry and entry[0] > now:
+                self._local.move_to_end(key)
+                return entry[1]
+        
+        with self.engine.connect() as conn:
+            row = conn.execute(select(self.table).where(self.table.c.key == key,
+                                                        self.table.c.expires_at > now)).first()
+        if row is None:
+            return None
+        value = json.loads(row.value)
+        self._remember(key, value, row.expires_at)
+        return value
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+        with self.store.transaction() as conn:
+            conn.execute(delete(self.table).where(self.table.c.key == key))
+            conn.execute(insert(self.table).values(key=key, value=json.dumps(value), expires_at=expires_at))
+
+    def _remember(self, key, value, expires_at):
+        with self._lock:
+            self._local[key] = (expires_at, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+
+    def get_or_load(self, key, loader, cacheable=lambda value: True):
+        """Return the cached value or call loader() once for all concurrent callers"""
+        value = self.get(key)
+        if value is not None:
+            self.count('hits')
+            return value
+        
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = [threading.Event(), None]
+        
+        if not leader:
+            self.count('coalesced')
+            call[0].wait()
+            return call[1]
+        
+        self.count('misses')
+        try:
+            call[1] = loader()
+            if cacheable(call[1]):
+                self.set(key, call[1])
+            return call[1]
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call[0].set()
+
+    def purge_expired(self):
+        with self.store.transaction() as conn:
+            conn.execute(delete(self.table).where(self.table.c.expires_at <= time.time()))
+
+
+metadata_cache = MetadataCache(store, 'metadata_cache', app.config['METADATA_CACHE_TTL'],
+                               app.config['METADATA_CACHE_SIZE'])
+info_cache = MetadataCache(store, 'info_cache', app.config['INFO_CACHE_TTL'], 128)
+
+class OutputCache:
+    """Finished files keyed by (extractor, media ID, format_key).
+
+    A key is either 'building' (owned by the job downloading it) or 'ready'.
+    The table is the index of everything in `folder`: files are evicted when
+    they expire, when the cache exceeds max_bytes, or when the disk passes the
+    high watermark, without ever listing the folder.
+    """
+
+    HANDOUT_GRACE = 300  # seconds a file handed to a job is kept even when space is needed
+
+    def __init__(self, store, folder, max_bytes, ttl, high_watermark, low_watermark):
+        self.store = store
+        self.engine = store.engine
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.metadata = MetaData()
+        self.table = Table(
+            'artifacts', self.metadata,
+            Column('key', String(255), primary_key=True),
+            Column('status', String(16), nullable=False),
+            Column('job_id', String(36), nullable=False),
+            Column('path', Text, nullable=False, default=''),
+            Column('title', Text, nullable=False, default=''),
+            Column('size', Integer, nullable=False, default=0),
+            Column('created_at', Float, nullable=False),
+            Column('last_access', Float, nullable=False, index=True),
+            Column('expires_at', Float, nullable=True, index=True),
+        )
+        store.create_tables(self.metadata)
+        os.makedirs(folder, exist_ok=True)
+        self.stats = {'hits': 0, 'misses': 0, 'attached': 0, 'evicted': 0}
+
+    def count(self, result):
+        self.stats[result] += 1
+        CACHE_LOOKUPS.labels('output_cache', result).inc()
+
+    def _get(self, conn, key):
+        row = conn.execute(select(self.table).where(self.table.c.key == key)).first()
+        return dict(row._mapping) if row else None
+
+    def claim(self, key, job_id):
+        """Claim a key for job_id. Returns None if the caller must build it,
+        otherwise the existing 'ready' or 'building' entry."""
+        for attempt in range(5):
+            try:
+                artifact, result = self._claim(key, job_id)
+                break
+            except (IntegrityError, OperationalError):
+                # Worker lain mengklaim key yang sama bersamaan: baca ulang supaya job ini menempel padanya
+                if attempt == 4:
+                    raise
+        self.count(result)
+        return artifact
+
+    def _claim(self, key, job_id):
+        now = time.time()
+        with self.store.transaction() as conn:
+            artifact = self._get(conn, key)
+            if artifact and artifact['status'] == 'ready' and os.path.exists(artifact['path']):
+                conn.execute(update(self.table).where(self.table.c.key == key)
+                             .values(last_access=now, expires_at=now + self.ttl))
+                return artifact, 'hits'
+            
+            if artifact and artifact['status'] == 'building':
+                # Job pembangun boleh sudah dibatalkan selama job lain masih menunggu unduhannya
+                if self.store.attached_jobs(artifact['job_id']):
+                    return artifact, 'attached'
+            
+            # Belum ada, file hilang, atau pembuatnya gagal: job ini yang membangun
+            if artifact:
+                conn.execute(delete(self.table).where(self.table.c.key == key,
+                                                      self.table.c.job_id == artifact['job_id']))
+            conn.execute(insert(self.table).values(key=key, status='building', job_id=job_id,
+                                                   created_at=now, last_access=now))
+        return None, 'misses'
+
+    def get_ready(self, key):
+        """The 'ready' entry for key or None. The caller hands it to a job, so it counts as an access"""
+        with self.engine.connect() as conn:
+            artifact = self._get(conn, key)
+        if not (artifact and artifact['status'] == 'ready'):
+            return None
+        now = time.time()
+        with self.store.transaction() as conn:
+            conn.execute(update(self.table).where(self.table.c.key == key)
+                         .values(last_access=now, expires_at=now + self.ttl))
+        return artifact
+
+    def store_file(self, key, job_id, filepath, title):
+        """Move a finished file into the cache and mark the key ready. Returns the new path"""
+        ext = os.path.splitext(filepath)[1]
+        path = os.path.join(self.folder, hashlib.sha1(key.encode()).hexdigest() + ext)
+        shutil.move(filepath, path)
+        size = os.path.getsize(path)
+        with self.store.transaction() as conn:
+            conn.execute(update(self.table)
+                         .where(self.table.c.key == key, self.table.c.job_id == job_id)
+                         .values(status='ready', path=path, title=title, size=size,
+                                 last_access=time.time(), expires_at=time.time() + self.ttl))
+        self.evict(keep=key)
+        return path
+
+    def take_over(self, key, previous_job_id, job_id):
+        """Move a 'building' claim to job_id. False if the claim changed meanwhile"""
+        c = self.table.c
+        with self.store.transaction() as conn:
+            return conn.execute(update(self.table)
+                                .where(c.key == key, c.job_id == previous_job_id, c.status == 'building')
+                                .values(job_id=job_id)).rowcount == 1
+
+    def release(self, key, job_id):
+        """Drop a 'building' claim after its job failed"""
+        with self.store.transaction() as conn:
+            conn.execute(delete(self.table).where(self.table.c.key == key,
+                                                  self.table.c.job_id == job_id,
+                                                  self.table.c.status == 'building'))
+
+    def evict(self, keep=None):
+        """Delete expired files, then least recently used ones while the cache is
+        over its quota or the disk is above the high watermark. The entry `keep`
+        (just stored) and files handed to a job within HANDOUT_GRACE are spared"""
+        c = self.table.c
+        ready = c.status == 'ready'
+        evictable = ready if keep is None else and_(ready, c.key != keep)
+        expired = or_(c.expires_at < time.time(), c.expires_at.is_(None))
+        while True:
+            with self.engine.connect() as conn:
+                victims = conn.execute(select(c.key, c.path, c.size)
+                                       .where(evictable, expired).limit(100)).all()
+            if not victims:
+                break
+            for victim in victims:
+                self._remove(victim)
+        
+        with self.engine.connect() as conn:
+            total = conn.execute(select(func.coalesce(func.sum(c.size), 0)).where(ready)).scalar()
+        to_free = total - self.max_bytes
+        disk = shutil.disk_usage(self.folder)
+        if disk.used > disk.total * self.high_watermark:
+            to_free = max(to_free, disk.used - disk.total * self.low_watermark)
+        
+        while to_free > 0:
+            with self.engine.connect() as conn:
+                victims = conn.execute(select(c.key, c.path, c.size)
+                                       .where(evictable, c.last_access < time.time() - self.HANDOUT_GRACE)
+                                       .order_by(c.last_access).limit(50)).all()
+            if not victims:
+                break
+            for victim in victims:
+                self._remove(victim)
+                to_free -= victim.size
+                if to_free <= 0:
+                    break
+
+    def _remove(self, victim):
+        with self.store.transaction() as conn:
+            conn.execute(delete(self.table).where(self.table.c.key == victim.key))
+        try:
+            os.remove(victim.path)
+        except OSError:
+            pass
+        self.stats['evicted'] += 1
+
+    def usage(self):
+        """(number of files, total bytes) of ready entries"""
+        c = self.table.c
+        with self.engine.connect() as conn:
+            return tuple(conn.execute(select(func.count(), func.coalesce(func.sum(c.size), 0))
+                                      .where(c.status == 'ready')).one())
+
+
+output_cache = OutputCache(store, app.config['CACHE_FOLDER'], app.config['OUTPUT_CACHE_MAX_BYTES'],
+                           app.config['OUTPUT_CACHE_TTL'], app.config['DISK_HIGH_WATERMARK'],
+                           app.config['DISK_LOW_WATERMARK'])
+
+class DownloadScheduler:
+    """Priority job queue with separate fetch and transcode worker pools.
+
+    Within a priority level clients are served round-robin, so one client
+    with many queued jobs cannot hold back everyone else. Speculative tasks
+    (PRIORITY_PREFETCH) give up their fetch slot when a regular job needs it.
+    """
+
+    def __init__(self, fetch_workers, transcode_workers):
+        self.fetch_workers = max(1, fetch_workers)
+        self.transcode_workers = max(1, transcode_workers)
+        self._cond = threading.Condition()
+        self._queues = {}  # priority -> OrderedDict(client -> deque of job_ids), client next in line first
+        self._pending = {}  # job_id -> (func, args)
+        self._cancelled = set()
+        self._fetching = {}  # job_id -> priority of jobs holding a fetch slot
+        self._running = set()  # jobs running in this process, in either pool
+        self._fetch_slots = threading.BoundedSemaphore(self.fetch_workers)
+        self._transcode_slots = threading.BoundedSemaphore(self.transcode_workers)
+        self._local = threading.local()
+        self._pid = None
+
+    def _ensure_started(self):
+        # Thread tidak ikut ter-fork, jadi pool dibuat di proses yang memakainya
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        for _ in range(self.fetch_workers + self.transcode_workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, job_id, func, args=(), priority=PRIORITY_INTERACTIVE, client=None):
+        """Queue a job; func(*args) runs once a fetch slot is free"""
+        with self._cond:
+            self._ensure_started()
+            self._pending[job_id] = (func, args)
+            clients = self._queues.setdefault(priority, OrderedDict())
+            clients.setdefault(client, deque()).append(job_id)
+            if priority < PRIORITY_PREFETCH:
+                self._preempt()
+            self._cond.notify()
+
+    def _preempt(self):
+        # Semua slot fetch terpakai: hentikan satu prefetch spekulatif supaya job biasa tidak menunggu
+        if len(self._fetching) < self.fetch_workers:
+            return
+        for job_id, priority in self._fetching.items():
+            if priority >= PRIORITY_PREFETCH and job_id not in self._cancelled:
+                self._cancelled.add(job_id)
+                return
+
+    def busy(self):
+        """Whether regular jobs are waiting or every fetch slot is taken"""
+        with self._cond:
+            if len(self._fetching) >= self.fetch_workers:
+                return True
+            return any(job_id in self._pending
+                       for priority, clients in self._queues.items() if priority < PRIORITY_PREFETCH
+                       for jobs in clients.values() for job_id in jobs)
+
+    def cancel(self, job_id):
+        """Cancel a job. Returns 'queued' if it never started, 'running' if it was
+        flagged, None if it is not in this process (finished or run by another worker)"""
+        with self._cond:
+            if self._pending.pop(job_id, None) is not None:
+                return 'queued'
+            # Job di worker lain berhenti lewat cek database di check_cancelled
+            if job_id not in self._running:
+                return None
+            self._cancelled.add(job_id)
+            return 'running'
+
+    def is_cancelled(self, job_id):
+        return job_id in self._cancelled
+
+    def queue_position(self, job_id):
+        """1-based position among queued jobs, or None if not queued"""
+        with self._cond:
+            if job_id not in self._pending:
+                return None
+            position = 0
+            for priority in sorted(self._queues):
+                # Urutan round-robin: job pertama tiap klien, lalu job kedua, dst.
+                lines = [[queued for queued in jobs if queued in self._pending]
+                         for jobs in self._queues[priority].values()]
+                for turn in itertools.zip_longest(*lines):
+                    for queued in turn:
+                        if queued is None:
+                            continue
+                        position += 1
+                        if queued == job_id:
+                            return position
+        return None
+
+    def enter_transcode(self):
+        """Move the calling job from its fetch slot to a transcode slot"""
+        if getattr(self._local, 'stage', None) != 'fetch':
+            return
+        self._fetch_slots.release()
+        with self._cond:
+            self._fetching.pop(self._local.job_id, None)
+        self._local.stage = 'waiting'
+        self._transcode_slots.acquire()
+        self._local.stage = 'transcode'
+
+    def acquire_transcode_slot(self, timeout):
+        """Take a transcode slot for work running outside the queue (streaming)"""
+        return self._transcode_slots.acquire(timeout=timeout)
+    
+    def release_transcode_slot(self):
+        self._transcode_slots.release()
+    
+    def _next(self):
+        with self._cond:
+            while True:
+                for priority in sorted(self._queues):
+                    clients = self._queues[priority]
+                    while clients:
+                        client, jobs = next(iter(clients.items()))
+                        job_id = jobs.popleft()
+                        # Klien ini mendapat giliran; pindah ke belakang antrean
+                        del clients[client]
+                        if jobs:
+                            clients[client] = jobs
+                        task = self._pending.pop(job_id, None)
+                        if task is not None:  # skip entries cancelled while queued
+                            self._fetching[job_id] = priority
+                            self._running.add(job_id)
+                            return job_id, task
+                    del self._queues[priority]
+                self._cond.wait()
+
+    def _worker(self):
+        while True:
+            self._fetch_slots.acquire()
+            job_id, (func, args) = self._next()
+            self._local.job_id = job_id
+            self._local.stage = 'fetch'
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"Job {job_id} crashed: {e}")
+            finally:
+                if self._local.stage == 'fetch':
+                    self._fetch_slots.release()
+                elif self._local.stage == 'transcode':
+                    self._transcode_slots.release()
+                self._local.stage = None
+                with self._cond:
+                    self._fetching.pop(job_id, None)
+                    self._running.discard(job_id)
+                    self._cancelled.discard(job_id)
+
+
+class BatchFeeder:
+    """Feeds the items of a batch into the download queue a window at a time.
+
+    The uploaded URL list is read line by line and playlist/channel URLs are
+    expanded lazily, so a batch never has to fit in memory or in the queue.
+    """
+
+    MAX_DEPTH = 3  # channel -> tab -> playlist
+
+    def __init__(self, window):
+        self.window = max(1, window)
+
+    def start(self, batch_id):
+        threading.Thread(target=self.run, args=(batch_id,), daemon=True).start()
+
+    def run(self, batch_id):
+        batch = store.get_batch(batch_id)
+        # Batch yang diambil alih dari worker yang mati: lewati item yang sudah diantrekan
+        total = batch['total']
+        try:
+            for url, title in itertools.islice(self.items(batch['source_path']), total, None):
+                self.wait_for_room(batch_id)
+                if byte_quota_retry_after(batch['user_ip']):
+                    store.update_batch(batch_id, message='Daily download quota reached')
+                    break
+                fields = {'title': title} if title else {}
+                queue_download(url, batch['format_key'], generate_job_id(), batch['user_ip'],
+                               PRIORITY_BATCH, batch_id=batch_id, **fields)
+                total += 1
+                store.update_batch(batch_id, total=total)
+            store.update_batch(batch_id, status='expanded')
+        except Exception as e:
+            store.update_batch(batch_id, status='expanded', message=str(e))
+        finally:
+            if os.path.exists(batch['source_path']):
+                os.remove(batch['source_path'])
+
+    def items(self, source_path):
+        """(url, title) for every item of an uploaded URL list"""
+        with open(source_path, encoding='utf-8', errors='replace') as source:
+            for line in source:
+                url = line.strip()
+                if not url or not downloader.validate_url(url):
+                    continue
+                try:
+                    yield from self.expand(url)
+                except yt_dlp.utils.DownloadError:
+                    # URL yang gagal dibaca tetap masuk sebagai item; unduhannya yang melaporkan error
+                    yield url, None
+
+    def expand(self, url, depth=0):
+        """A single video as-is, or every entry of a playlist/channel, nested playlists included"""
+        if downloader.extract_video_id(url):
+            yield url, None
+            return
+        # Header yang sama dengan unduhannya (BROWSER_HEADERS untuk situs selain YouTube)
+        ydl_opts = dict(downloader.ydl_options(url, {}), quiet=True, no_warnings=True,
+                        extract_flat='in_playlist', lazy_playlist=True)
+        with ydl_pool.get(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=False, process=False)
+            if info.get('_type') not in ('playlist', 'multi_video'):
+                if info.get('formats') or info.get('url'):
+                    # Ekstraksi sudah dibayar; simpan supaya unduhannya tidak mengulang
+                    info_cache.set(downloader.canonical_key(url), downloader.compact_info(ydl, info))
+                yield url, info.get('title')
+                return
+            # entries berupa generator: halaman playlist baru diambil saat dibutuhkan
+            for entry in info.get('entries') or []:
+                entry_url = entry.get('webpage_url') or entry.get('url')
+                if not entry_url:
+                    continue
+                if depth >= self.MAX_DEPTH or self.is_video_entry(entry, entry_url):
+                    yield entry_url, entry.get('title')
+                    continue
+                # Channel berisi tab, playlist berisi playlist: dibuka juga, tetap lazy
+                try:
+                    yield from self.expand(entry_url, depth + 1)
+                except yt_dlp.utils.DownloadError:
+                    yield entry_url, entry.get('title')
+
+    @staticmethod
+    def is_video_entry(entry, entry_url):
+        """Whether a flat playlist entry is a single video rather than another playlist"""
+        if entry.get('_type') == 'playlist':
+            return False
+        if downloader.extract_video_id(entry_url):
+            return True
+        # Extractor yang hanya menghasilkan video tidak perlu dibuka lagi
+        ie_key = entry.get('ie_key')
+        try:
+            return bool(ie_key) and yt_dlp.extractor.get_info_extractor(ie_key)._RETURN_TYPE == 'video'
+        except (KeyError, AttributeError):
+            return False
+
+    def wait_for_room(self, batch_id):
+        """Backpressure: block while the batch already has a full window queued or running"""
+        while True:
+            counts = store.batch_counts(batch_id)
+            if counts.get('queued', 0) + counts.get('processing', 0) < self.window:
+                return
+            store.wait_for_change(1)
+
+
+# Encoder FFmpeg per format audio
+AUDIO_ENCODERS = {
+    'mp3': 'libmp3lame',
+    'flac': 'flac',
+    'm4a': 'aac',
+    'opus': 'libopus',
+    'wav': 'pcm_s16le',
+}
+LOSSY_EXTENSIONS = {'mp3', 'm4a', 'opus'}
+# Container yang mendukung cover art sebagai stream gambar (attached_pic)
+COVER_ART_EXTENSIONS = {'mp3', 'flac', 'm4a', 'mp4'}
+# Codec audio yang bisa disalin apa adanya ke MP4
+MP4_AUDIO_CODECS = {'mp4a', 'aac', 'opus', 'mp3', 'flac', 'ac-3', 'ec-3'}
+# Muxer FFmpeg per ekstensi; wajib ditulis eksplisit saat output berupa pipe
+OUTPUT_MUXERS = {'mp3': 'mp3', 'flac': 'flac', 'm4a': 'ipod', 'opus': 'opus', 'wav': 'wav', 'mp4': 'mp4'}
+# Format yang muxer-nya bisa ditulis berurutan ke pipe (mp4/m4a butuh seek untuk moov atom)
+STREAMABLE_EXTENSIONS = {'mp3', 'flac', 'opus', 'wav'}
+# Protokol yang bisa dibaca FFmpeg langsung dari URL sumber
+STREAMABLE_PROTOCOLS = {'http', 'https', 'm3u8', 'm3u8_native'}
+STREAM_CHUNK_SIZE = 64 * 1024
+MIMETYPES = {'mp3': 'audio/mpeg', 'flac': 'audio/flac', 'm4a': 'audio/mp4', 'wav': 'audio/wav', 'opus': 'audio/opus', 'mp4': 'video/mp4'}
+EXTENSION_ACODECS = {'m4a': 'mp4a', 'aac': 'mp4a', 'opus': 'opus', 'flac': 'flac', 'mp3': 'mp3'}
+# Header browser untuk situs selain YouTube (lihat ydl_options)
+BROWSER_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9',
+}
+# Label tingkat dua yang dipakai registry ccTLD sebagai suffix publik (co.uk, com.br, com.au, co.id, ...)
+PUBLIC_SECOND_LEVEL = {'ac', 'co', 'com', 'edu', 'go', 'gov', 'ltd', 'me', 'ne', 'net', 'nom', 'or', 'org', 'plc', 'sch', 'web'}
+
+
+def registrable_domain(hostname):
+    """Domain a hostname is registered under, e.g. bbc.co.uk for www.bbc.co.uk"""
+    if re.fullmatch(r'[\d.]+|[\da-f:]+', hostname):
+        return hostname
+    labels = hostname.split('.')
+    # Tanpa daftar suffix lengkap: ccTLD dua huruf dengan label umum di depannya dianggap suffix publik
+    size = 3 if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in PUBLIC_SECOND_LEVEL else 2
+    return '.'.join(labels[-size:])
+
+
+class OutboundGovernor:
+    """Process-wide limits for outbound HTTP, per host.
+
+    Every request takes a token from the host's bucket. A 429/403 halves the
+    host's rate and connection budget and pauses it; successes restore the
+    rate slowly (AIMD). Fragmented downloads share the host's connection
+    budget, which grows while extra connections still add throughput.
+    """
+
+    MAX_RETRIES = {429: 3, 403: 1}
+
+    def __init__(self, rate, burst, max_connections):
+        self.rate = max(0.1, rate)
+        self.burst = max(1, burst)
+        self.max_connections = max(1, max_connections)
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self.stats = {'throttled': 0, 'backoffs': 0}
+
+    def _host(self, url):
+        hostname = (urllib.parse.urlparse(url).hostname or '').lower()
+        # CDN memakai banyak subdomain (rr1---sn-xxx.googlevideo.com): kelompokkan per domain
+        key = registrable_domain(hostname)
+        state = self._hosts.get(key)
+        if state is None:
+            state = self._hosts[key] = {
+                'rate': self.rate, 'tokens': float(self.burst), 'updated': time.monotonic(),
+                'paused_until': 0, 'jobs': 0,
+                'connections': max(1, self.max_connections // 2), 'throughput': None,
+            }
+        return state
+
+    def acquire(self, url):
+        """Block until the URL's host may receive another request"""
+        while True:
+            with self._lock:
+                state = self._host(url)
+                now = time.monotonic()
+                state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * state['rate'])
+                state['updated'] = now
+                delay = state['paused_until'] - now
+                if delay <= 0:
+                    if state['tokens'] >= 1:
+                        state['tokens'] -= 1
+                        return
+                    delay = (1 - state['tokens']) / state['rate']
+                self.stats['throttled'] += 1
+            time.sleep(min(delay, 5))
+
+    def succeeded(self, url):
+        with self._lock:
+            state = self._host(url)
+            state['rate'] = min(self.rate, state['rate'] + 0.1)
+
+    def backoff(self, url, retry_after, attempt):
+        """Slow the host down after a 429/403. Returns seconds to wait before retrying"""
+        delay = retry_after if retry_after is not None else 2 ** attempt + random.random()
+        delay = min(delay, 60)
+        with self._lock:
+            state = self._host(url)
+            state['rate'] = max(0.5, state['rate'] / 2)
+            state['connections'] = max(1, state['connections'] // 2)
+            state['paused_until'] = max(state['paused_until'], time.monotonic() + delay)
+            self.stats['backoffs'] += 1
+        return delay
+
+    @contextmanager
+    def fetching(self, url):
+        """Register a job downloading from the URL's host; yields its fragment concurrency"""
+        with self._lock:
+            state = self._host(url)
+            state['jobs'] += 1
+            connections = max(1, state['connections'] // state['jobs'])
+        try:
+            yield connections
+        finally:
+            with self._lock:
+                state['jobs'] -= 1
+
+    def report(self, url, nbytes, seconds, connections):
+        """Adapt the host's connection budget from the throughput a fragmented download reached"""
+        if seconds <= 0 or nbytes < 1024**2:
+            return  # Terlalu kecil untuk diukur
+        per_connection = nbytes / seconds / connections
+        with self._lock:
+            state = self._host(url)
+            average = state['throughput']
+            if average is None or per_connection >= 0.8 * average:
+                state['connections'] = min(self.max_connections, state['connections'] + 1)
+            else:
+                # Koneksi tambahan tidak lagi menambah kecepatan: host sudah jenuh
+                state['connections'] = max(1, state['connections'] - 1)
+            state['throughput'] = per_connection if average is None else 0.7 * average + 0.3 * per_connection
+
+
+governor = OutboundGovernor(app.config['HOST_REQUEST_RATE'], app.config['HOST_REQUEST_BURST'],
+                            app.config['HOST_MAX_CONNECTIONS'])
+
+
+class GovernedYoutubeDL(yt_dlp.YoutubeDL):
+    """YoutubeDL whose HTTP requests (extractor pages, streams, fragments) go through the governor"""
+
+    def urlopen(self, req):
+        url = req if isinstance(req, str) else req.url if hasattr(req, 'url') else req.full_url
+        for attempt in itertools.count():
+            governor.acquire(url)
+            try:
+                response = super().urlopen(req)
+            except yt_dlp.networking.exceptions.HTTPError as e:
+                if attempt >= governor.MAX_RETRIES.get(e.status, 0):
+                    raise
+                retry_after = e.response.get_header('Retry-After')
+                time.sleep(governor.backoff(url, int(retry_after) if retry_after and retry_after.isdigit() else None,
+                                            attempt))
+                continue
+            governor.succeeded(url)
+            return response
+
+
+class YDLPool:
+    """Reusable, pre-configured YoutubeDL instances keyed by option profile.
+
+    A pooled instance keeps its extractor objects and HTTP connections between
+    calls. It is used by one thread at a time and is dropped after an error.
+    """
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = {}  # profile -> [YoutubeDL]
+        self._pid = None
+        self.stats = {'created': 0, 'reused': 0}
+
+    @contextmanager
+    def get(self, params, progress=None):
+        """Borrow an instance built from params; progress receives yt-dlp progress dicts"""
+        profile = json.dumps(params, sort_keys=True)
+        with self._lock:
+            if self._pid != os.getpid():
+                # Koneksi milik proses induk tidak boleh dipakai setelah fork
+                self._idle, self._pid = {}, os.getpid()
+            idle = self._idle.get(profile)
+            ydl = idle.pop() if idle else None
+        if ydl is None:
+            ydl = self._create(params)
+            self.stats['created'] += 1
+        else:
+            self.stats['reused'] += 1
+        
+        ydl.progress_callback = progress
+        try:
+            yield ydl
+        except BaseException:
+            ydl.close()
+            raise
+        ydl.progress_callback = None
+        with self._lock:
+            idle = self._idle.setdefault(profile, [])
+            if len(idle) < self.max_idle:
+                idle.append(ydl)
+                return
+        ydl.close()
+
+    @staticmethod
+    def _create(params):
+        ydl = GovernedYoutubeDL(params)
+        ydl.progress_callback = None
+        ydl.add_progress_hook(lambda d: ydl.progress_callback and ydl.progress_callback(d))
+        return ydl
+
+
+ydl_pool = YDLPool(app.config['YDL_POOL_SIZE'])
+
+
+class ExtractionPool:
+    """Bounded thread pool for metadata lookups.
+
+    Request threads only wait for a lookup with a timeout, so slow sites cannot
+    pin every worker. Lookups for the same key share one future, and a lookup
+    nobody waits for anymore is cancelled if it has not started yet.
+    """
+
+    def __init__(self, workers, max_pending):
+        self.workers = max(1, workers)
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> [future, waiters]
+        self._executor = None
+        self._pid = None
+
+    def submit(self, key, func, *args):
+        """Future for func(*args), shared with other callers of the same key.
+        None when too many lookups are already pending"""
+        with self._lock:
+            if self._pid != os.getpid():
+                # Thread pool tidak ikut ter-fork
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='extract')
+                self._inflight, self._pid = {}, os.getpid()
+            entry = self._inflight.get(key)
+            if entry:
+                entry[1] += 1
+                return entry[0]
+            if not self._slots.acquire(blocking=False):
+                return None
+            future = self._executor.submit(func, *args)
+            self._inflight[key] = [future, 1]
+        future.add_done_callback(lambda done: self._finished(key, done))
+        return future
+
+    def abandon(self, key, future):
+        """A waiter timed out or went away"""
+        with self._lock:
+            entry = self._inflight.get(key)
+            if not entry or entry[0] is not future:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+        future.cancel()
+
+    def _finished(self, key, future):
+        with self._lock:
+            if self._inflight.get(key, [None])[0] is future:
+                del self._inflight[key]
+        self._slots.release()
+
+
+extraction_pool = ExtractionPool(app.config['EXTRACT_WORKERS'], app.config['EXTRACT_MAX_PENDING'])
+
+
+def reap_process(process):
+    """Wait for a child process whose pipes are drained; returns the CPU seconds it used"""
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return usage.ru_utime + usage.ru_stime
 
-# In-memory storage for downloads (in production, use database)
-download_history = []
-active_downloads = {}
 
 class YouTubeDownloader:
     def __init__(self):
+        self.ffmpeg_path = None
+        self._cancel_checked = {}
+        self._progress_written = {}  # job_id -> (time, progress) of the last stored update
+        self.pipeline_stats = {'copy': 0, 'transcode': 0}
+        # Extractor plugin yt-dlp (yt_dlp_plugins di sys.path) dimuat sekarang, bukan saat
+        # YoutubeDL pertama dibuat, supaya canonical_key langsung mengenalinya
+        yt_dlp.plugins.load_all_plugins()
         self.quality_options = {
             'mp4_1080': {'name': 'MP4 Full HD (1080p)', 'height': 1080, 'ext': 'mp4', 'type': 'video'},
             'mp4_720': {'name': 'MP4 HD (720p)', 'height': 720, 'ext': 'mp4', 'type': 'video'},
@@ -38,9 +1390,9 @@ class YouTubeDownloader:
             'mp3_320': {'name': 'MP3 Ultra HD', 'bitrate': '320k', 'ext': 'mp3', 'type': 'audio'},
             'mp3_256': {'name': 'MP3 High Quality', 'bitrate': '256k', 'ext': 'mp3', 'type': 'audio'},
             'mp3_192': {'name': 'MP3 Standard', 'bitrate': '192k', 'ext': 'mp3', 'type': 'audio'},
-            'flac': {'name': 'FLAC Lossless', 'bitrate': '1411k', 'ext': 'flac', 'type': 'audio'},
-            'm4a': {'name': 'M4A/AAC', 'bitrate': '256k', 'ext': 'm4a', 'type': 'audio'},
-            'opus': {'name': 'OPUS', 'bitrate': '160k', 'ext': 'opus', 'type': 'audio'},
+            'flac': {'name': 'FLAC Lossless', 'bitrate': '1411k', 'ext': 'flac', 'type': 'audio', 'acodec': 'flac'},
+            'm4a': {'name': 'M4A/AAC', 'bitrate': '256k', 'ext': 'm4a', 'type': 'audio', 'acodec': 'mp4a'},
+            'opus': {'name': 'OPUS', 'bitrate': '160k', 'ext': 'opus', 'type': 'audio', 'acodec': 'opus'},
             'wav': {'name': 'WAV', 'bitrate': '1411k', 'ext': 'wav', 'type': 'audio'}
         }
     
@@ -64,8 +1416,28 @@ class YouTubeDownloader:
         # Allow any http/https URL, let yt-dlp handle specific validation
         return url.strip().startswith(('http://', 'https://'))
     
+    def canonical_key(self, url):
+        """Cache key for a URL: extractor key + media ID (falls back to the URL itself)"""
+        video_id = self.extract_video_id(url)
+        if video_id:
+            return f'Youtube:{video_id}'
+        
+        url = url.strip().split('#', 1)[0]
+        for ie in yt_dlp.extractor.gen_extractor_classes():
+            if ie.suitable(url):
+                return f'{ie.ie_key()}:{ie.get_temp_id(url) or url}'
+        return f'Generic:{url}'
+    
     def get_video_info(self, url):
-        """Get video information without downloading"""
+        """Get video information without downloading (cached)"""
+        return metadata_cache.get_or_load(
+            self.canonical_key(url),
+            lambda: self._extract_video_info(url),
+            cacheable=lambda info: info.get('success'),
+        )
+    
+    def _extract_video_info(self, url):
+        """Extract video information from the remote site"""
         try:
             ydl_opts = {
                 'quiet': True,
@@ -78,15 +1450,14 @@ class YouTubeDownloader:
             # Tambahkan User-Agent untuk menghindari blokir TikTok/Instagram
             # Tapi jangan gunakan untuk YouTube karena bisa menyebabkan Error 403
             if not ('youtube.com' in url or 'youtu.be' in url):
-                ydl_opts['http_headers'] = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
-                    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
-                    'Accept-Language': 'en-US,en;q=0.9',
-                }
+                ydl_opts['http_headers'] = BROWSER_HEADERS
             
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            with ydl_pool.get(ydl_opts) as ydl:
                 info = ydl.extract_info(url, download=False)
                 
+                # Simpan info lengkap sebentar supaya /api/download tidak mengekstrak ulang
+                info_cache.set(self.canonical_key(url), self.compact_info(ydl, info))
+                
                 # Get available formats
                 audio_formats = []
                 for f in info.get('formats', []):
@@ -117,193 +1488,729 @@ class YouTubeDownloader:
     
     def download_media(self, url, format_key, job_id, user_ip):
         """Download media (audio/video) with specified format"""
+        cache_key = None
+        stage = 'queued'
+        workdir = os.path.join(app.config['WORK_FOLDER'], job_id)
         try:
+            # Semua job yang menempel sudah dibatalkan sebelum sempat berjalan
+            job = store.get_job(job_id)
+            if job is None or not store.attached_jobs(job_id):
+                if job:
+                    output_cache.release(job['cache_key'], job_id)
+                return False
+            cache_key = job['cache_key']
+            labels = job_metric_labels(job)
+            
             if format_key not in self.quality_options:
                 format_key = 'mp3_320'
             
             quality = self.quality_options[format_key]
-            is_video = quality.get('type') == 'video'
             
-            # Secara eksplisit temukan path FFmpeg untuk yt-dlp
-            import shutil
-            ffmpeg_path = shutil.which('ffmpeg')
+            ffmpeg_path = self.ffmpeg_binary()
+            ydl_opts = self.ydl_options(url, quality)
+            resuming = bool(job.get('format_id'))
+            if resuming:
+                # Job yang terputus: pilih format yang sama supaya file .part di workdir diteruskan
+                ydl_opts['format'] = f"{job['format_id']}/{ydl_opts['format']}"
+            else:
+                QUEUE_WAIT.labels(priority_label(job['priority'])).observe(time.time() - job['created_at'])
             
-            # Fallback untuk lingkungan hosting di mana PATH mungkin tidak lengkap
-            if not ffmpeg_path and os.path.exists('/usr/bin/ffmpeg'):
-                ffmpeg_path = '/usr/bin/ffmpeg'
+            # Update status
+            stage = 'extracting'
+            store.update_build(job_id, status='processing', progress=0, stage=stage,
+                               message='Resuming download...' if resuming else 'Starting download...')
+            os.makedirs(workdir, exist_ok=True)
+            timings = {}
             
-            # Configure yt-dlp options
-            ydl_opts = {
-                'format': 'bestaudio/best', # Default, overridden below
-                'outtmpl': os.path.join(tempfile.gettempdir(), f'{job_id}.%(ext)s'),
-                'quiet': False,
-                'no_warnings': False,
-                'progress_hooks': [self.progress_hook],
-                'writethumbnail': True,
-                'embedthumbnail': True,
-                'addmetadata': True,
-                'concurrent_fragment_downloads': 4,
-                'nocheckcertificate': True,
-                'geo_bypass': True,
-            }
+            with ydl_pool.get(ydl_opts, progress=lambda d: self.progress_hook(d, job_id)) as ydl:
+                started = time.time()
+                info, from_cache = self.select_formats(ydl, url)
+                timings['extract'] = round(time.time() - started, 3)
+                STAGE_SECONDS.labels('extract', *labels).observe(timings['extract'])
+                stage = 'downloading'
+                store.update_build(job_id, stage=stage)
+                store.update_job(job_id, format_id=info.get('format_id'))
+                
+                started = time.time()
+                staged = None
+                if quality['type'] == 'audio' and prefetcher.enabled:
+                    staged = prefetcher.staged(self.canonical_key(url), job_id, quality.get('acodec'))
+                if staged:
+                    # Audio sudah diunduh secara spekulatif; cukup dikonversi
+                    inputs = [self.use_staged(staged, info, workdir)]
+                else:
+                    try:
+                        inputs = self.fetch_streams(ydl, info, job_id, workdir)
+                    except yt_dlp.utils.DownloadError as e:
+                        if not (from_cache and self.is_expired_stream_error(e)):
+                            raise
+                        # URL stream dari cache sudah kedaluwarsa
+                        info, _ = self.select_formats(ydl, url, use_cache=False)
+                        store.update_job(job_id, format_id=info.get('format_id'))
+                        inputs = self.fetch_streams(ydl, info, job_id, workdir)
+                thumbnail = self.fetch_thumbnail(ydl, info, job_id, workdir)
+                timings['download'] = round(time.time() - started, 3)
             
-            # Tambahkan User-Agent untuk menghindari blokir TikTok/Instagram
-            # Tapi jangan gunakan untuk YouTube karena bisa menyebabkan Error 403
-            if not ('youtube.com' in url or 'youtu.be' in url):
-                ydl_opts['http_headers'] = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
-                    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
-                    'Accept-Language': 'en-US,en;q=0.9',
-                }
+            STAGE_SECONDS.labels('download', *labels).observe(timings['download'])
+            fetched = 0 if staged else sum(os.path.getsize(path) for path, _ in inputs if os.path.exists(path))
+            DOWNLOAD_BYTES.labels(*labels).inc(fetched)
+            if fetched and timings['download'] > 0:
+                DOWNLOAD_SPEED.labels(labels[1]).observe(fetched / timings['download'])
             
-            if ffmpeg_path:
-                ydl_opts['ffmpeg_location'] = ffmpeg_path
-
-            if is_video:
-                height = quality.get('height', 720)
-                ydl_opts.update({
-                    'format': f'bestvideo[height<={height}]+bestaudio/best[height<={height}]',
-                    'merge_output_format': 'mp4',
-                })
-                # Video postprocessors (metadata only)
-                ydl_opts['postprocessors'] = [{
-                    'key': 'EmbedThumbnail',
-                }, {
-                    'key': 'FFmpegMetadata',
-                }]
-            else:
-                # Audio postprocessors
-                ydl_opts['format'] = 'bestaudio/best'
-                if quality['ext'] == 'mp3':
-                    ydl_opts['postprocessors'] = [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': quality['bitrate'], # Gunakan bitrate langsung
-                    }, {
-                        'key': 'EmbedThumbnail',
-                    }, {
-                        'key': 'FFmpegMetadata',
-                    }]
-                
-                elif quality['ext'] == 'flac':
-                    ydl_opts['postprocessors'] = [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'flac',
-                    }, {
-                        'key': 'EmbedThumbnail',
-                    }]
+            final_filepath = os.path.join(workdir, f"output.{quality['ext']}")
+            command, pipeline = self.build_ffmpeg_command(ffmpeg_path, inputs, thumbnail, quality, info, final_filepath)
             
-            # Update status
-            active_downloads[job_id] = {
-                'status': 'processing',
-                'progress': 0,
-                'filename': '',
-                'message': 'Starting download...'
-            }
+            # Transcode berjalan di slot transcode; stream copy cukup murah untuk langsung jalan
+            if pipeline == 'transcode':
+                store.update_build(job_id, message='Waiting for converter...')
+                scheduler.enter_transcode()
+                self.check_cancelled(job_id)
+            stage = 'postprocessing'
+            store.update_build(job_id, progress=100, stage=stage,
+                               message='Converting...' if pipeline == 'transcode' else 'Remuxing...')
             
-            # Start download
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                
-                # Get the final file path from the info dict after post-processing
-                final_filepath = info.get('requested_downloads', [{}])[0].get('filepath')
-
-                active_downloads[job_id].update({
-                    'status': 'completed',
-                    'progress': 100,
-                    'filename': os.path.basename(final_filepath),
-                    'filepath': final_filepath,
-                    'filesize': os.path.getsize(final_filepath) if final_filepath and os.path.exists(final_filepath) else 0,
-                    'title': info.get('title', 'Unknown'),
-                    'quality': quality['name']
-                })
-                
-                # Add to history
-                download_history.append({
-                    'job_id': job_id,
-                    'url': url,
-                    'title': info.get('title', 'Unknown'),
-                    'quality': quality['name'],
-                    'timestamp': datetime.now().isoformat(),
-                    'user_ip': user_ip,
-                    'filesize': active_downloads[job_id]['filesize']
-                })
-                
-                return True
+            started = time.time()
+            FFMPEG_CPU.labels(pipeline).inc(self.run_ffmpeg(command, job_id))
+            timings['postprocess'] = round(time.time() - started, 3)
+            STAGE_SECONDS.labels('postprocess', *labels).observe(timings['postprocess'])
+            self.pipeline_stats[pipeline] += 1
+            
+            title = info.get('title', 'Unknown')
+            final_filepath = output_cache.store_file(cache_key, job_id, final_filepath, title)
+            complete_jobs(store.attached_jobs(job_id), final_filepath, title, quality['name'],
+                          timings=timings, pipeline=pipeline)
+            
+            return True
                 
+        except yt_dlp.utils.DownloadCancelled:
+            output_cache.release(cache_key, job_id)
+            store.update_build(job_id, status='cancelled', progress=0, message='Download cancelled')
+            return False
         except Exception as e:
-            active_downloads[job_id] = {
-                'status': 'error',
-                'progress': 0,
-                'message': str(e)
-            }
+            ERRORS.labels(stage, type(e).__name__).inc()
+            output_cache.release(cache_key, job_id)
+            store.update_build(job_id, status='error', progress=0, message=str(e))
             return False
+        finally:
+            self._cancel_checked.pop(job_id, None)
+            self._progress_written.pop(job_id, None)
+            # Hapus file sementara (stream mentah, thumbnail, output yang belum jadi).
+            # Jika worker mati di tengah jalan, folder ini tetap ada dan dipakai saat job dilanjutkan
+            shutil.rmtree(workdir, ignore_errors=True)
+    
+    def find_ffmpeg(self):
+        """Path of the FFmpeg executable or None; looked up once per process"""
+        if not self.ffmpeg_path:
+            # Secara eksplisit temukan path FFmpeg
+            self.ffmpeg_path = shutil.which('ffmpeg')
+            
+            # Fallback untuk lingkungan hosting di mana PATH mungkin tidak lengkap
+            if not self.ffmpeg_path and os.path.exists('/usr/bin/ffmpeg'):
+                self.ffmpeg_path = '/usr/bin/ffmpeg'
+        return self.ffmpeg_path
+    
+    def ffmpeg_binary(self):
+        """Path of the FFmpeg executable"""
+        ffmpeg_path = self.find_ffmpeg()
+        if not ffmpeg_path:
+            raise RuntimeError('FFmpeg is not installed')
+        return ffmpeg_path
+    
+    def ydl_options(self, url, quality):
+        """yt-dlp options selecting the source formats for a quality option"""
+        # Configure yt-dlp options. yt-dlp hanya memilih format dan mengunduh;
+        # merge, konversi, cover art dan tag dikerjakan FFmpeg dalam satu proses.
+        ydl_opts = {
+            'format': 'bestaudio/best', # Default, overridden below
+            'quiet': False,
+            'no_warnings': False,
+            'noplaylist': True,
+            'nocheckcertificate': True,
+            'geo_bypass': True,
+        }
+        # Tambahkan User-Agent untuk menghindari blokir TikTok/Instagram
+        # Tapi jangan gunakan untuk YouTube karena bisa menyebabkan Error 403
+        if not ('youtube.com' in url or 'youtu.be' in url):
+            ydl_opts['http_headers'] = BROWSER_HEADERS
+        
+        if quality.get('type') == 'video':
+            height = quality.get('height', 720)
+            ydl_opts['format'] = f'bestvideo[height<={height}]+bestaudio/best[height<={height}]'
+        elif quality.get('acodec'):
+            # Utamakan stream yang codec-nya sudah sesuai agar cukup di-remux (stream copy)
+            ydl_opts['format'] = f"bestaudio[acodec^={quality['acodec']}]/bestaudio/best"
+        return ydl_opts
+    
+    def open_stream(self, url, format_key, job_id):
+        """Start FFmpeg reading the source URL directly and writing the result to
+        its stdout. Returns (process, first_chunk, info, pipeline)"""
+        quality = self.quality_options[format_key]
+        ffmpeg_path = self.ffmpeg_binary()
+        with ydl_pool.get(self.ydl_options(url, quality)) as ydl:
+            info, from_cache = self.select_formats(ydl, url)
+            if from_cache and not self.stream_reachable(ydl, info):
+                # URL stream dari cache sudah kedaluwarsa
+                info, _ = self.select_formats(ydl, url, use_cache=False)
+        if info.get('requested_formats') or info.get('protocol') not in STREAMABLE_PROTOCOLS:
+            raise ValueError('This source cannot be streamed, use a normal download instead')
+        
+        thumbnail = info.get('thumbnail')
+        while True:
+            # FFmpeg mengambil sendiri dari sumber, jadi token host diambil di sini
+            governor.acquire(info['url'])
+            command, pipeline = self.build_ffmpeg_command(
+                ffmpeg_path, [(info['url'], info)], thumbnail, quality, info, 'pipe:1')
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            first_chunk = process.stdout.read1(STREAM_CHUNK_SIZE)
+            if first_chunk:
+                return process, first_chunk, info, pipeline
+            _, stderr = process.communicate()
+            if process.returncode == 0:
+                raise RuntimeError('FFmpeg produced no output')
+            if not (thumbnail and quality['ext'] in COVER_ART_EXTENSIONS):
+                raise RuntimeError(f"FFmpeg failed: {stderr.decode(errors='replace').strip()[-500:]}")
+            # Cover art gagal diambil: ulangi tanpa cover
+            thumbnail = None
+    
+    def stream_reachable(self, ydl, info):
+        """Whether the stream URL of a cached info dict still answers"""
+        request = yt_dlp.networking.Request(info['url'], headers=info.get('http_headers') or {}, method='HEAD')
+        try:
+            ydl.urlopen(request).close()
+            return True
+        except yt_dlp.networking.exceptions.HTTPError as e:
+            return e.status not in (403, 404, 410)
+        except Exception:
+            return True
     
-    def progress_hook(self, d):
-        """Progress hook for yt-dlp"""
+    def compact_info(self, ydl, info):
+        """JSON-serializable info dict without the parts a download never needs"""
+        info = ydl.sanitize_info(info, remove_private_keys=True)
+        for key in ('automatic_captions', 'subtitles', 'requested_subtitles', 'thumbnails', 'heatmap'):
+            info.pop(key, None)
+        return info
+    
+    def select_formats(self, ydl, url, use_cache=True):
+        """Resolve the formats to download. Uses the info dict kept by
+        get_video_info when available. Returns (info, from_cache)"""
+        info = info_cache.get(self.canonical_key(url)) if use_cache else None
+        if info is not None:
+            try:
+                return ydl.process_ie_result(info, download=False), True
+            except yt_dlp.utils.ReExtractInfo:
+                pass
+        return ydl.extract_info(url, download=False), False
+    
+    def fetch_streams(self, ydl, info, job_id, workdir):
+        """Download every selected format as-is; returns [(path, format_info)]"""
+        inputs = []
+        for fmt in info.get('requested_formats') or [info]:
+            fmt_info = dict(info)
+            fmt_info.pop('requested_formats', None)
+            fmt_info.update(fmt)
+            path = os.path.join(workdir, f"source.f{fmt['format_id']}.{fmt['ext']}")
+            with governor.fetching(fmt_info['url']) as connections:
+                # Jumlah fragmen paralel dibagi rata antar job yang mengunduh dari host yang sama
+                ydl.params['concurrent_fragment_downloads'] = connections
+                started = time.time()
+                try:
+                    success, _ = ydl.dl(path, fmt_info)
+                except yt_dlp.networking.exceptions.network_exceptions as e:
+                    # Seperti process_info: error jaringan jadi DownloadError, penyebabnya di exc_info
+                    raise yt_dlp.utils.DownloadError(f'unable to download video data: {e}',
+                                                     (type(e), e, e.__traceback__)) from e
+            if success and (fmt_info.get('fragments') or fmt_info.get('protocol', '').startswith(('m3u8', 'http_dash'))):
+                governor.report(fmt_info['url'], os.path.getsize(path), time.time() - started, connections)
+            if not success:
+                raise yt_dlp.utils.DownloadError(f"Failed to download format {fmt['format_id']}")
+            inputs.append((path, fmt_info))
+        return inputs
+    
+    def use_staged(self, staged, info, workdir):
+        """Input (path, format_info) for a file staged by the prefetcher, linked
+        into workdir so eviction cannot remove it while FFmpeg reads it"""
+        staged_path, staged_format = staged
+        path = os.path.join(workdir, f"source.prefetch.{staged_format['ext']}")
+        try:
+            os.link(staged_path, path)
+        except OSError:
+            shutil.copyfile(staged_path, path)
+        fmt_info = dict(info)
+        fmt_info.pop('requested_formats', None)
+        fmt_info.update(staged_format)
+        return path, fmt_info
+    
+    def fetch_thumbnail(self, ydl, info, job_id, workdir):
+        """Download the cover image; returns its path or None"""
+        if not info.get('thumbnail'):
+            return None
+        path = os.path.join(workdir, 'cover')
+        try:
+            with ydl.urlopen(info['thumbnail']) as response, open(path, 'wb') as f:
+                shutil.copyfileobj(response, f)
+            return path
+        except Exception as e:
+            # Cover art tidak wajib
+            print(f"Thumbnail download failed for {job_id}: {e}")
+            return None
+    
+    def build_ffmpeg_command(self, ffmpeg_path, inputs, thumbnail, quality, info, output):
+        """Single FFmpeg invocation doing merge/transcode, cover art and tags.
+        Returns (command, pipeline) where pipeline is 'copy' when no stream is re-encoded"""
+        command = [ffmpeg_path, '-y', '-hide_banner', '-loglevel', 'error', '-nostdin']
+        for path, fmt in inputs:
+            if '://' in path and fmt.get('http_headers'):
+                # Input dibaca langsung dari URL sumber (mode streaming)
+                command += ['-headers', ''.join(f'{k}: {v}\r\n' for k, v in fmt['http_headers'].items())]
+            command += ['-i', path]
+        
+        ext = quality['ext']
+        cover = thumbnail if ext in COVER_ART_EXTENSIONS else None
+        if cover:
+            command += ['-i', cover]
+        
+        if quality.get('type') == 'video':
+            if len(inputs) > 1:
+                command += ['-map', '0:v:0', '-map', '1:a:0']
+            else:
+                command += ['-map', '0:v:0', '-map', '0:a:0?']
+            copy_audio = self.source_acodec(inputs[-1][1]) in MP4_AUDIO_CODECS
+            pipeline = 'copy' if copy_audio else 'transcode'
+            command += ['-c:v', 'copy', '-c:a', 'copy' if copy_audio else 'aac']
+            if cover:
+                command += ['-map', f'{len(inputs)}:v:0', '-c:v:1', 'mjpeg', '-disposition:v:1', 'attached_pic']
+        else:
+            if quality.get('acodec') and self.source_acodec(inputs[0][1]) == quality['acodec']:
+                # Codec sumber sudah sama dengan target: remux tanpa encode ulang
+                pipeline = 'copy'
+                command += ['-map', '0:a:0', '-c:a', 'copy']
+            else:
+                pipeline = 'transcode'
+                command += ['-map', '0:a:0', '-c:a', AUDIO_ENCODERS[ext]]
+                if ext in LOSSY_EXTENSIONS:
+                    command += ['-b:a', quality['bitrate']]
+            if cover:
+                command += ['-map', '1:v:0', '-c:v', 'mjpeg', '-disposition:v', 'attached_pic']
+                if ext == 'mp3':
+                    command += ['-id3v2_version', '3', '-metadata:s:v', 'title=Album cover',
+                                '-metadata:s:v', 'comment=Cover (front)']
+        
+        for tag, value in self.metadata_tags(info).items():
+            command += ['-metadata', f'{tag}={value}']
+        return command + ['-f', OUTPUT_MUXERS[ext], output], pipeline
+    
+    def source_acodec(self, fmt):
+        """Audio codec family of a downloaded format ('mp4a', 'opus', ...)"""
+        acodec = (fmt.get('acodec') or '').split('.')[0].lower()
+        if acodec and acodec != 'none':
+            return acodec
+        # Link file langsung sering tidak menyertakan codec; tebak dari ekstensinya
+        return EXTENSION_ACODECS.get(fmt.get('ext'), '')
+    
+    def metadata_tags(self, info):
+        """Tags written into the output file"""
+        tags = {
+            'title': info.get('track') or info.get('title'),
+            'artist': info.get('artist') or info.get('creator') or info.get('uploader') or info.get('channel'),
+            'album': info.get('album'),
+            'date': (info.get('release_date') or info.get('upload_date') or '')[:4],
+            'comment': info.get('webpage_url'),
+        }
+        return {tag: value for tag, value in tags.items() if value}
+    
+    def run_ffmpeg(self, command, job_id):
+        """Run FFmpeg, killing it if the job gets cancelled. Returns its CPU seconds"""
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        stderr = b''
+        with process.stderr, selectors.DefaultSelector() as selector:
+            selector.register(process.stderr, selectors.EVENT_READ)
+            while True:
+                # FFmpeg menutup stderr saat selesai; sementara itu cek pembatalan tiap detik
+                if selector.select(timeout=1):
+                    chunk = os.read(process.stderr.fileno(), 65536)
+                    if not chunk:
+                        break
+                    stderr += chunk
+                try:
+                    self.check_cancelled(job_id)
+                except yt_dlp.utils.DownloadCancelled:
+                    process.kill()
+                    process.wait()
+                    raise
+        cpu_seconds = reap_process(process)
+        if process.returncode != 0:
+            raise RuntimeError(f"FFmpeg failed: {stderr.decode(errors='replace').strip()[-500:]}")
+        return cpu_seconds
+    
+    def is_expired_stream_error(self, error):
+        """Whether a DownloadError looks like an expired or revoked stream URL"""
+        cause = error.exc_info[1] if error.exc_info else error.__cause__
+        if isinstance(cause, yt_dlp.networking.exceptions.HTTPError):
+            return cause.status in (403, 404, 410)
+        return re.search(r'HTTP Error (403|404|410)', str(error)) is not None
+    
+    def check_cancelled(self, job_id):
+        """Abort a running yt-dlp download once its job has been cancelled"""
+        if scheduler.is_cancelled(job_id):
+            raise yt_dlp.utils.DownloadCancelled()
+        
+        # Pembatalan bisa datang dari worker lain; cek database paling sering sekali per detik
+        now = time.time()
+        if now - self._cancel_checked.get(job_id, 0) >= 1:
+            self._cancel_checked[job_id] = now
+            if not store.attached_jobs(job_id):
+                raise yt_dlp.utils.DownloadCancelled()
+    
+    def progress_hook(self, d, job_id):
+        """Progress hook for yt-dlp, bound to a single job"""
+        self.check_cancelled(job_id)
+        
         if d['status'] == 'downloading':
             # Try to get percentage
-            if '_percent_str' in d:
-                percent = d['_percent_str'].strip().replace('%', '')
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            if total:
+                progress = min(100.0, d.get('downloaded_bytes', 0) * 100.0 / total)
+            elif '_percent_str' in d:
                 try:
-                    progress = float(percent)
-                    # Update progress for active downloads
-                    for job_id in active_downloads:
-                        if active_downloads[job_id]['status'] == 'processing':
-                            active_downloads[job_id]['progress'] = progress
-                            active_downloads[job_id]['message'] = f"Downloading... {progress:.1f}%"
-                except:
-                    pass
+                    progress = float(re.sub(r'\x1b\[[0-9;]*m', '', d['_percent_str']).strip().rstrip('%'))
+                except ValueError:
+                    return
+            else:
+                return
+            
+            # yt-dlp memanggil hook berkali-kali per detik; simpan paling sering
+            # dua kali per detik kecuali progres melonjak
+            now = time.time()
+            last_time, last_progress = self._progress_written.get(job_id, (0, 0))
+            if now - last_time < 0.5 and progress - last_progress < 5:
+                return
+            self._progress_written[job_id] = (now, progress)
+            store.update_build(job_id, progress=progress, message=f"Downloading... {progress:.1f}%")
 
 downloader = YouTubeDownloader()
+scheduler = DownloadScheduler(app.config['FETCH_WORKERS'], app.config['TRANSCODE_WORKERS'])
+batch_feeder = BatchFeeder(app.config['BATCH_QUEUE_WINDOW'])
+
+class AudioPrefetcher:
+    """Speculative fetch of the best audio stream while the user picks a format.
 
-def cleanup_old_files():
-    """Background task to clean up old files and history every 24 hours"""
-    global download_history
-    while True:
+    After a successful video info lookup the source audio is downloaded at
+    PRIORITY_PREFETCH into a staging folder indexed by the 'prefetch' table,
+    so an audio download that follows only has to run FFmpeg. Speculation is
+    skipped while jobs are queued, gives way to regular jobs, and staged
+    files are evicted after ttl, beyond max_bytes or under disk pressure.
+    """
+
+    STALL_SECONDS = 10  # a fetching entry without progress for this long is not waited for
+
+    def __init__(self, store, folder, max_bytes, max_file_bytes, ttl, wait, enabled):
+        self.store = store
+        self.engine = store.engine
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.ttl = ttl
+        self.wait = wait
+        self.enabled = enabled
+        self.metadata = MetaData()
+        self.table = Table(
+            'prefetch', self.metadata,
+            Column('key', String(255), primary_key=True),
+            Column('status', String(16), nullable=False),  # queued, fetching, ready
+            Column('task_id', String(64), nullable=False),
+            Column('path', Text, nullable=False, default=''),
+            Column('format', Text, nullable=False, default='{}'),
+            Column('size', Integer, nullable=False, default=0),
+            Column('updated_at', Float, nullable=False),
+            Column('expires_at', Float, nullable=False, index=True),
+        )
+        store.create_tables(self.metadata)
+        os.makedirs(folder, exist_ok=True)
+        self.stats = {'started': 0, 'skipped': 0, 'cancelled': 0, 'hits': 0, 'misses': 0, 'evicted': 0}
+        self._touched = {}  # task_id -> time updated_at was last written
+
+    def count(self, result):
+        self.stats[result] += 1
+        CACHE_LOOKUPS.labels('prefetch', result).inc()
+
+    def _get(self, conn, key):
+        row = conn.execute(select(self.table).where(self.table.c.key == key)).first()
+        return dict(row._mapping) if row else None
+
+    def speculate(self, url):
+        """Queue a prefetch of the audio of url unless one exists or the server is busy"""
+        if not self.enabled:
+            return
+        if scheduler.busy() or self.store.count_jobs('queued'):
+            self.count('skipped')
+            return
+        key = downloader.canonical_key(url)
+        task_id = f'prefetch-{uuid.uuid4()}'
+        now = time.time()
         try:
-            temp_dir = tempfile.gettempdir()
-            now = time.time()
-            cutoff = now - 86400  # 24 hours in seconds
-            
-            # Extensions created by the app
-            valid_extensions = {'.mp3', '.mp4', '.flac', '.m4a', '.opus', '.wav', '.webm', '.part', '.ytdl'}
-            
-            for filename in os.listdir(temp_dir):
-                file_path = os.path.join(temp_dir, filename)
-                
-                if os.path.exists(file_path) and os.path.isfile(file_path):
-                    _, ext = os.path.splitext(filename)
-                    if ext.lower() in valid_extensions:
-                        # Check if it looks like a UUID (length 36 with hyphens) - to avoid deleting system files
-                        name_part = os.path.splitext(filename)[0]
-                        if len(name_part) == 36 and '-' in name_part:
-                            if os.path.getmtime(file_path) < cutoff:
-                                try:
-                                    os.remove(file_path)
-                                except Exception as e:
-                                    print(f"Error deleting old file {filename}: {e}")
-            
-            # Cleanup history older than 24 hours
-            cutoff_dt = datetime.fromtimestamp(cutoff)
-            # Filter history keeping only items newer than cutoff
-            new_history = []
-            for item in download_history:
-                try:
-                    # Parse timestamp from string
-                    item_dt = datetime.fromisoformat(item['timestamp'])
-                    if item_dt > cutoff_dt:
-                        new_history.append(item)
-                except (ValueError, TypeError):
-                    pass
-            
-            download_history = new_history
+            with self.store.transaction() as conn:
+                entry = self._get(conn, key)
+                if entry and entry['expires_at'] > now:
+                    return
+                if entry:
+                    conn.execute(delete(self.table).where(self.table.c.key == key,
+                                                          self.table.c.task_id == entry['task_id']))
+                conn.execute(insert(self.table).values(key=key, status='queued', task_id=task_id,
+                                                       updated_at=now, expires_at=now + self.ttl))
+        except (IntegrityError, OperationalError):
+            # Worker lain baru saja memulai prefetch untuk URL yang sama
+            return
+        if entry and entry['path']:
+            self._unlink(entry['path'])
+        self.count('started')
+        scheduler.submit(task_id, self.fetch, (key, url, task_id), priority=PRIORITY_PREFETCH)
+
+    def fetch(self, key, url, task_id):
+        """Scheduler task downloading the staged audio for key"""
+        c = self.table.c
+        with self.store.transaction() as conn:
+            started = conn.execute(update(self.table)
+                                   .where(c.key == key, c.task_id == task_id, c.status == 'queued')
+                                   .values(status='fetching', updated_at=time.time())).rowcount
+        if not started:
+            return
+        workdir = os.path.join(app.config['WORK_FOLDER'], task_id)
+        os.makedirs(workdir, exist_ok=True)
+        try:
+            quality = {'type': 'audio'}
+            with ydl_pool.get(downloader.ydl_options(url, quality),
+                              progress=lambda d: self.progress_hook(d, key, task_id)) as ydl:
+                info, _ = downloader.select_formats(ydl, url)
+                size = info.get('filesize') or info.get('filesize_approx') or 0
+                if info.get('requested_formats') or size > self.max_file_bytes:
+                    raise ValueError('Source is not a single audio stream within PREFETCH_MAX_FILE_BYTES')
+                # Format dicatat sebelum diunduh: job dengan codec lain tidak perlu menunggu
+                staged_format = {field: info.get(field) for field in ('format_id', 'ext', 'acodec', 'vcodec', 'abr', 'asr')}
+                with self.store.transaction() as conn:
+                    conn.execute(update(self.table).where(c.key == key, c.task_id == task_id)
+                                 .values(format=json.dumps(staged_format)))
+                self.evict(reserve=size)
+                [(source, fmt)] = downloader.fetch_streams(ydl, info, task_id, workdir)
             
+            size = os.path.getsize(source)
+            DOWNLOAD_BYTES.labels('prefetch', key.split(':', 1)[0]).inc(size)
+            path = os.path.join(self.folder, f"{task_id}.{fmt['ext']}")
+            os.replace(source, path)
+            with self.store.transaction() as conn:
+                stored = conn.execute(update(self.table).where(c.key == key, c.task_id == task_id)
+                                      .values(status='ready', path=path, size=size,
+                                              updated_at=time.time())).rowcount
+            self._touched.pop(task_id, None)
+            if not stored:
+                # Dihapus selagi diunduh (evict atau prefetch baru)
+                self._unlink(path)
+            self.evict()
+        except yt_dlp.utils.DownloadCancelled:
+            self.count('cancelled')
+            self.release(key, task_id)
         except Exception as e:
-            print(f"Cleanup task error: {e}")
+            print(f"Prefetch of {url} failed: {e}")
+            self.release(key, task_id)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def progress_hook(self, d, key, task_id):
+        """Abort a prefetch that was preempted, evicted or grew past max_file_bytes"""
+        if scheduler.is_cancelled(task_id) or d.get('downloaded_bytes', 0) > self.max_file_bytes:
+            raise yt_dlp.utils.DownloadCancelled()
+        # updated_at menandai prefetch masih berjalan bagi download yang menunggunya; tulis sekali per detik
+        now = time.time()
+        if now - self._touched.get(task_id, 0) < 1:
+            return
+        self._touched[task_id] = now
+        c = self.table.c
+        with self.store.transaction() as conn:
+            alive = conn.execute(update(self.table).where(c.key == key, c.task_id == task_id)
+                                 .values(updated_at=now)).rowcount
+        if not alive:
+            raise yt_dlp.utils.DownloadCancelled()
+
+    def release(self, key, task_id):
+        """Drop the entry of a prefetch that did not finish"""
+        self._touched.pop(task_id, None)
+        with self.store.transaction() as conn:
+            conn.execute(delete(self.table).where(self.table.c.key == key, self.table.c.task_id == task_id))
+
+    def staged(self, key, job_id, acodec=None):
+        """(path, format info) of the staged audio for key, waiting up to `wait`
+        seconds for a prefetch in progress. None if nothing usable is staged or,
+        when acodec is given, the staged codec differs (a matching source can be
+        stream-copied, which beats transcoding the staged file)"""
+        deadline = time.time() + self.wait
+        while True:
+            with self.engine.connect() as conn:
+                entry = self._get(conn, key)
+            now = time.time()
+            if entry is None or entry['expires_at'] < now:
+                break
+            staged_format = json.loads(entry['format'])
+            if acodec and staged_format and downloader.source_acodec(staged_format) != acodec:
+                break
+            if entry['status'] == 'ready':
+                if not os.path.exists(entry['path']):
+                    break
+                self.count('hits')
+                return entry['path'], staged_format
+            if entry['status'] == 'queued':
+                # Belum mulai (server sibuk): lebih cepat diunduh oleh job ini sendiri
+                scheduler.cancel(entry['task_id'])
+                self.release(key, entry['task_id'])
+                break
+            if now > deadline or now - entry['updated_at'] > self.STALL_SECONDS:
+                break
+            downloader.check_cancelled(job_id)
+            time.sleep(0.25)
+        self.count('misses')
+        return None
+
+    def evict(self, reserve=0):
+        """Delete expired entries, then the oldest staged files while the staging
+        area (plus `reserve` bytes) is over max_bytes. Under disk pressure all
+        staged files go, before anything in the output cache"""
+        c = self.table.c
+        ready = c.status == 'ready'
+        with self.engine.connect() as conn:
+            victims = conn.execute(select(c.key, c.task_id, c.path)
+                                   .where(c.expires_at < time.time())).all()
+            total = conn.execute(select(func.coalesce(func.sum(c.size), 0)).where(ready)).scalar()
+        for victim in victims:
+            self._remove(victim)
         
-        # Check every hour
-        time.sleep(3600)
+        to_free = total + reserve - self.max_bytes
+        disk = shutil.disk_usage(self.folder)
+        if disk.used > disk.total * output_cache.high_watermark:
+            to_free = float('inf')
+        while to_free > 0:
+            with self.engine.connect() as conn:
+                victims = conn.execute(select(c.key, c.task_id, c.path, c.size)
+                                       .where(ready).order_by(c.updated_at).limit(50)).all()
+            if not victims:
+                break
+            for victim in victims:
+                self._remove(victim)
+                to_free -= victim.size
+                if to_free <= 0:
+                    break
+
+    def _remove(self, victim):
+        with self.store.transaction() as conn:
+            conn.execute(delete(self.table).where(self.table.c.key == victim.key,
+                                                  self.table.c.task_id == victim.task_id))
+        if victim.path:
+            self._unlink(victim.path)
+        self.stats['evicted'] += 1
+
+    def _unlink(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def usage(self):
+        """(number of files, total bytes) of staged audio"""
+        c = self.table.c
+        with self.engine.connect() as conn:
+            return tuple(conn.execute(select(func.count(), func.coalesce(func.sum(c.size), 0))
+                                      .where(c.status == 'ready')).one())
+
+
+prefetcher = AudioPrefetcher(store, app.config['PREFETCH_FOLDER'], app.config['PREFETCH_MAX_BYTES'],
+                             app.config['PREFETCH_MAX_FILE_BYTES'], app.config['PREFETCH_TTL'],
+                             app.config['PREFETCH_WAIT'], app.config['PREFETCH_ENABLED'])
+
+class PeriodicTask:
+    """Runs func every interval seconds in a daemon thread of each worker process"""
+
+    def __init__(self, func, interval):
+        self.func = func
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_started(self):
+        # Seperti scheduler: thread dibuat di proses worker, bukan sebelum fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.func()
+            except Exception as e:
+                print(f"{self.func.__name__} failed: {e}")
+            time.sleep(self.interval)
+
+def cleanup_storage():
+    """Evict cached files, expire history/metadata and drop abandoned work folders"""
+    # File staging prefetch dikorbankan lebih dulu daripada file hasil
+    prefetcher.evict()
+    output_cache.evict()
+    
+    # Cleanup history older than 24 hours
+    cutoff = time.time() - 86400
+    store.purge_history(datetime.fromtimestamp(cutoff).isoformat())
+    metadata_cache.purge_expired()
+    info_cache.purge_expired()
+    
+    # Folder kerja normalnya dihapus oleh job-nya; sisa proses yang mati ditangani di sini
+    if not os.path.isdir(app.config['WORK_FOLDER']):
+        return
+    for entry in os.scandir(app.config['WORK_FOLDER']):
+        if entry.is_dir() and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+storage_maintenance = PeriodicTask(cleanup_storage, app.config['STORAGE_SWEEP_INTERVAL'])
+
+def recover_jobs():
+    """Send this worker's heartbeat and take over jobs and batches of workers that died"""
+    store.heartbeat()
+    timeout = app.config['JOB_LEASE_TIMEOUT']
+    for job in store.orphaned_builds(timeout):
+        if not store.take_over(store.jobs, job['job_id'], job['owner']):
+            continue
+        if job.get('streaming'):
+            # Stream langsung ke browser tidak bisa dilanjutkan; koneksinya ikut putus
+            output_cache.release(job['cache_key'], job['job_id'])
+            store.update_build(job['job_id'], status='error', progress=0,
+                               message='Interrupted by a server restart')
+            continue
+        # download_media meneruskan file .part/.ytdl yang tertinggal di folder kerja job ini
+        store.update_build(job['job_id'], status='queued', message='Resuming after restart...')
+        scheduler.submit(job['job_id'], downloader.download_media,
+                         (job['url'], job['format_key'], job['job_id'], job['user_ip']),
+                         priority=job['priority'], client=job['user_ip'])
+    for batch in store.orphaned_batches(timeout):
+        if store.take_over(store.batches, batch['batch_id'], batch['owner']):
+            batch_feeder.start(batch['batch_id'])
+
+job_journal = PeriodicTask(recover_jobs, app.config['JOB_HEARTBEAT_INTERVAL'])
+
+def warm_up():
+    """Prepare what every worker needs once, in the gunicorn master before it forks"""
+    downloader.find_ffmpeg()
+    # Memuat semua extractor dan mengompilasi pola URL-nya (URL ini dicocokkan ke semuanya)
+    downloader.canonical_key('https://example.com/warm-up')
+
+def after_fork():
+    """Drop resources inherited from the gunicorn master"""
+    # Koneksi database tidak boleh dipakai bersama antarproses
+    store.engine.dispose(close=False)
+    # Job yang terputus dilanjutkan tanpa menunggu request pertama
+    job_journal.ensure_started()
+
+def before_exit():
+    """Let other workers take over this worker's unfinished jobs immediately"""
+    store.retire_worker()
 
 # Helper functions
 def allowed_file(filename):
@@ -312,18 +2219,150 @@ def allowed_file(filename):
 def generate_job_id():
     return str(uuid.uuid4())
 
+def download_cache_key(url, format_key):
+    return f'{downloader.canonical_key(url)}|{format_key}'
+
+def queue_download(url, format_key, job_id, user_ip, priority, **fields):
+    """Register a job and serve it from the output cache, attach it to an
+    identical download in progress, or hand it to the scheduler"""
+    if format_key not in downloader.quality_options:
+        format_key = 'mp3_320'
+    cache_key = download_cache_key(url, format_key)
+    
+    quality_name = downloader.quality_options[format_key]['name']
+    artifact = output_cache.claim(cache_key, job_id)
+    if artifact and artifact['status'] == 'ready':
+        store.create_job(job_id, url, format_key, user_ip, priority, cache_key=cache_key, **fields)
+        complete_jobs([store.get_job(job_id)], artifact['path'], artifact['title'], quality_name)
+        return
+    
+    build_id = artifact['job_id'] if artifact else job_id
+    store.create_job(job_id, url, format_key, user_ip, priority, attached_to=build_id,
+                     cache_key=cache_key, filename='', message='Waiting in queue...', **fields)
+    if artifact is None:
+        task, args = downloader.download_media, (url, format_key, job_id, user_ip)
+        if fields.get('profile'):
+            task, args = profile_job, (job_id, task) + args
+        scheduler.submit(job_id, task, args, priority=priority, client=user_ip)
+        return
+    
+    # Unduhan yang ditempeli mungkin selesai tepat sebelum job ini tercatat
+    artifact = output_cache.get_ready(cache_key)
+    if artifact:
+        store.update_job(job_id, attached_to=None)
+        complete_jobs([store.get_job(job_id)], artifact['path'], artifact['title'], quality_name)
+
+profile_lock = threading.Lock()
+
+def profile_job(job_id, func, *args):
+    """Run one job under cProfile and save the stats as PROFILE_FOLDER/<job_id>.prof"""
+    # Hanya satu profiler aktif sekaligus; job lain berjalan tanpa profiling
+    if not profile_lock.acquire(blocking=False):
+        return func(*args)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        profile_lock.release()
+        os.makedirs(app.config['PROFILE_FOLDER'], exist_ok=True)
+        profiler.dump_stats(os.path.join(app.config['PROFILE_FOLDER'], f'{job_id}.prof'))
+
+def profiling_allowed():
+    key = app.config['PROFILE_KEY']
+    return bool(key) and request.headers.get('X-Profile-Key') == key
+
+def complete_jobs(jobs, filepath, title, quality_name, **fields):
+    """Mark jobs completed with a finished file and record them in history"""
+    filesize = os.path.getsize(filepath) if filepath and os.path.exists(filepath) else 0
+    for job in jobs:
+        store.update_job(
+            job['job_id'],
+            status='completed',
+            progress=100,
+            stage='done',
+            message='',
+            filename=os.path.basename(filepath),
+            filepath=filepath,
+            filesize=filesize,
+            title=title,
+            quality=quality_name,
+            **fields
+        )
+        
+        # Add to history
+        store.add_history(
+            job_id=job['job_id'],
+            url=job['url'],
+            title=title,
+            quality=quality_name,
+            timestamp=datetime.now().isoformat(),
+            user_ip=job['user_ip'],
+            filesize=filesize
+        )
+
+def public_job(job):
+    """Job fields returned to clients, with queue position for queued jobs"""
+    job = dict(job)
+    job.pop('user_ip', None)
+    job.pop('owner', None)
+    if job['status'] == 'queued':
+        build_id = job.get('attached_to') or job['job_id']
+        job['queue_position'] = scheduler.queue_position(build_id) or store.queue_position(build_id)
+    return job
+
 def get_client_ip():
     if request.headers.get('X-Forwarded-For'):
         return request.headers.get('X-Forwarded-For').split(',')[0]
     return request.remote_addr
 
+def too_many_requests(error, retry_after):
+    response = jsonify({'success': False, 'error': error})
+    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return response, 429
+
+def byte_quota_retry_after(user_ip):
+    """Seconds until a client over its 24-hour byte quota may download again, 0 if under it"""
+    quota = app.config['CLIENT_DAILY_BYTES']
+    if not quota:
+        return 0
+    now = time.time()
+    used, oldest = store.bytes_downloaded_since(user_ip, datetime.fromtimestamp(now - 86400).isoformat())
+    if used < quota:
+        return 0
+    # Kuota pulih saat entri tertua keluar dari jendela 24 jam
+    return datetime.fromisoformat(oldest).timestamp() + 86400 - now
+
+def check_client_limits(user_ip):
+    """429 response when a client may not start another download, otherwise None"""
+    max_active = app.config['CLIENT_MAX_ACTIVE_JOBS']
+    if max_active and store.count_active_jobs(user_ip) >= max_active:
+        return too_many_requests('Too many downloads in progress, wait for one to finish', 10)
+    
+    per_minute = app.config['CLIENT_JOBS_PER_MINUTE']
+    if per_minute:
+        now = time.time()
+        count, oldest = store.jobs_created_since(user_ip, now - 60)
+        if count >= per_minute:
+            return too_many_requests('Too many downloads, slow down', oldest + 60 - now)
+    
+    retry_after = byte_quota_retry_after(user_ip)
+    if retry_after:
+        return too_many_requests('Daily download quota reached', retry_after)
+    return None
+
 # Routes
+@app.before_request
+def start_background_tasks():
+    # Jalan di setiap mode deploy (flask run, gunicorn dengan/tanpa preload)
+    storage_maintenance.ensure_started()
+    job_journal.ensure_started()
+
 @app.route('/')
 def index():
     """Home page"""
     return render_template('index.html', 
                          quality_options=downloader.quality_options,
-                         recent_downloads=download_history[-10:])
+                         recent_downloads=store.recent_history(10))
 
 @app.route('/api/video-info', methods=['POST'])
 def get_video_info():
@@ -336,9 +2375,60 @@ def get_video_info():
     if not downloader.validate_url(url):
         return jsonify({'success': False, 'error': 'Invalid URL'})
     
-    info = downloader.get_video_info(url)
+    info = lookup_video_info([url])[0]
+    if info.get('busy'):
+        response = jsonify({'success': False, 'error': info['error']})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    if info.get('success'):
+        # Selagi pengguna memilih format, audionya sudah mulai diunduh
+        prefetcher.speculate(url)
     return jsonify(info)
 
+@app.route('/api/video-info/bulk', methods=['POST'])
+def get_video_info_bulk():
+    """Video information for a list of URLs, looked up concurrently"""
+    urls = request.json.get('urls')
+    if not isinstance(urls, list) or not urls:
+        return jsonify({'success': False, 'error': 'URL list required'})
+    if len(urls) > app.config['BULK_INFO_MAX_URLS']:
+        return jsonify({'success': False, 'error': f"At most {app.config['BULK_INFO_MAX_URLS']} URLs per request"})
+    
+    results = lookup_video_info(urls)
+    return jsonify({'success': True, 'results': [dict(result, url=url) for url, result in zip(urls, results)]})
+
+def lookup_video_info(urls):
+    """get_video_info for every URL on the extraction pool, waiting at most
+    VIDEO_INFO_TIMEOUT for all of them together"""
+    deadline = time.time() + app.config['VIDEO_INFO_TIMEOUT']
+    results = [None] * len(urls)
+    pending = {}
+    for index, url in enumerate(urls):
+        if not isinstance(url, str) or not downloader.validate_url(url):
+            results[index] = {'success': False, 'error': 'Invalid URL'}
+            continue
+        key = downloader.canonical_key(url)
+        cached = metadata_cache.get(key)
+        if cached is not None:
+            metadata_cache.count('hits')
+            results[index] = cached
+            continue
+        future = extraction_pool.submit(key, downloader.get_video_info, url)
+        if future is None:
+            results[index] = {'success': False, 'busy': True, 'error': 'Server is busy, try again shortly'}
+            continue
+        pending[index] = (key, future)
+    
+    wait([future for _, future in pending.values()], timeout=max(0, deadline - time.time()))
+    for index, (key, future) in pending.items():
+        if future.done() and not future.cancelled():
+            results[index] = future.result()
+        else:
+            # Ekstraksi yang sudah berjalan tetap selesai dan mengisi cache untuk percobaan berikutnya
+            extraction_pool.abandon(key, future)
+            results[index] = {'success': False, 'error': 'Timed out while reading video information'}
+    return results
+
 @app.route('/api/download', methods=['POST'])
 def start_download():
     """Start download process"""
@@ -351,52 +2441,376 @@ def start_download():
     if not downloader.validate_url(url):
         return jsonify({'success': False, 'error': 'Invalid URL'})
     
+    if format_key not in downloader.quality_options:
+        format_key = 'mp3_320'
+    user_ip = get_client_ip()
+    
+    # Klik ganda / kirim ulang: kembalikan job yang sudah berjalan
+    existing = store.find_active_job(user_ip, download_cache_key(url, format_key))
+    if existing:
+        return jsonify({
+            'success': True,
+            'job_id': existing['job_id'],
+            'duplicate': True,
+            'message': 'Download already queued'
+        })
+    
+    limited = check_client_limits(user_ip)
+    if limited:
+        return limited
+    
     # Generate job ID
     job_id = generate_job_id()
-    user_ip = get_client_ip()
+    fields = {'profile': True} if profiling_allowed() else {}
     
-    # Start download in background thread
-    thread = threading.Thread(
-        target=downloader.download_media,
-        args=(url, format_key, job_id, user_ip)
-    )
-    thread.daemon = True
-    thread.start()
+    queue_download(url, format_key, job_id, user_ip, PRIORITY_INTERACTIVE, **fields)
     
     return jsonify({
         'success': True,
         'job_id': job_id,
-        'message': 'Download started in background'
+        'message': 'Download queued'
     })
 
 @app.route('/api/status/<job_id>')
 def get_status(job_id):
     """Get download status"""
-    if job_id in active_downloads:
-        return jsonify(active_downloads[job_id])
+    job = store.get_job(job_id)
+    if job:
+        return jsonify(public_job(job))
     return jsonify({'status': 'not_found'})
 
+event_stream_slots = threading.BoundedSemaphore(max(0, app.config['EVENT_STREAM_MAX_CONNECTIONS']))
+
+@app.route('/api/events')
+def job_events():
+    """Server-Sent Events stream of status changes for all of the client's jobs"""
+    if not event_stream_slots.acquire(blocking=False):
+        response = jsonify({'success': False, 'error': 'Too many event streams, poll /api/status instead'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    user_ip = get_client_ip()
+    try:
+        since = float(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    except (TypeError, ValueError):
+        since = time.time() - 60
+    
+    def generate():
+        sent = {}  # job_id -> updated_at of the last event sent
+        queued = {}  # job_id -> last event sent for jobs still waiting in the queue
+        cursor = since
+        started = last_write = time.time()
+        yield 'retry: 2000\n\n'
+        
+        while time.time() - started < app.config['EVENT_STREAM_MAX_SECONDS']:
+            tick = time.time()
+            events = []
+            # Jendela 5 detik menangkap commit yang selesai sedikit terlambat
+            for job in store.jobs_updated_since(user_ip, cursor - 5):
+                if sent.get(job['job_id']) != job['updated_at']:
+                    sent[job['job_id']] = job['updated_at']
+                    events.append(public_job(job))
+            
+            changed = {payload['job_id'] for payload in events}
+            for job_id, payload in list(queued.items()):
+                if job_id not in changed:
+                    position = scheduler.queue_position(job_id) or store.queue_position(job_id)
+                    if position and position != payload.get('queue_position'):
+                        events.append(dict(payload, queue_position=position))
+            
+            for payload in events:
+                cursor = max(cursor, payload['updated_at'])
+                if payload['status'] == 'queued':
+                    queued[payload['job_id']] = payload
+                else:
+                    queued.pop(payload['job_id'], None)
+                yield f"id: {cursor}\nevent: job\ndata: {json.dumps(payload)}\n\n"
+                last_write = tick
+            
+            if tick - last_write >= 15:
+                yield ': ping\n\n'
+                last_write = tick
+            
+            store.wait_for_change(1)
+            # Gabungkan perubahan yang datang beruntun menjadi satu kiriman
+            time.sleep(max(0, 0.25 - (time.time() - tick)))
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Dilepas saat koneksi ditutup, juga bila generator tidak pernah dimulai
+    response.call_on_close(event_stream_slots.release)
+    return response
+
+@app.route('/api/cancel/<job_id>', methods=['POST'])
+def cancel_download(job_id):
+    """Cancel a queued or running download"""
+    job = store.get_job(job_id)
+    if not job or job['status'] not in ('queued', 'processing'):
+        return jsonify({'success': False, 'error': 'Job is not active'})
+    
+    # Unduhan dihentikan hanya jika tidak ada job lain yang menunggu. attached_to dibiarkan:
+    # job pembangun yang dibatalkan tetap menjadi kunci unduhan itu bagi job lain
+    build_id = job['attached_to']
+    store.update_job(job_id, status='cancelled', progress=0, message='Download cancelled')
+    if build_id and not store.attached_jobs(build_id):
+        scheduler.cancel(build_id)
+    return jsonify({'success': True, 'message': 'Cancellation requested'})
+
 @app.route('/api/download-file/<job_id>')
 def download_file(job_id):
     """Download completed file"""
-    if job_id in active_downloads and active_downloads[job_id]['status'] == 'completed':
-        filepath = active_downloads[job_id]['filepath']
-        original_filename = active_downloads[job_id]['filename'] # e.g., UUID.mp3
-        song_title = active_downloads[job_id].get('title', 'download')
+    job = store.get_job(job_id)
+    if job and job['status'] == 'completed':
+        if os.path.exists(job['filepath']):
+            return observe_serve(send_output_file(job['filepath'], job.get('title', 'download')), job)
+    
+    return "File not found", 404
+
+def observe_serve(response, job):
+    """Record the serve stage of a job, measured until the server closes the response body"""
+    started = time.time()
+    
+    def observe():
+        STAGE_SECONDS.labels('serve', *job_metric_labels(job)).observe(time.time() - started)
+    
+    body = response.response
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if not response.direct_passthrough:
+        response.call_on_close(observe)
+    elif file_wrapper and isinstance(body, file_wrapper):
+        # Body passthrough tidak melewati call_on_close, dan server hanya memakai
+        # sendfile() untuk objek file_wrapper-nya sendiri; jadi close-nya yang dibungkus
+        close = body.close
+        body.close = lambda: (close(), observe())
+    else:
+        response.response = ClosingIterator(body, observe)
+    return response
+
+def send_output_file(filepath, song_title):
+    """Serve a finished output with ETag, conditional and Range support.
+    The transfer itself is left to the front proxy or to sendfile()"""
+    # Sanitize the song title to create a valid filename
+    file_extension = os.path.splitext(filepath)[1]
+    download_name = f"{secure_filename(song_title)}{file_extension}"
+    
+    # Menentukan mimetype secara dinamis
+    mimetype = MIMETYPES.get(file_extension.strip('.'), 'application/octet-stream')
+    
+    mode = app.config['SENDFILE_MODE']
+    cache_folder = os.path.abspath(app.config['CACHE_FOLDER'])
+    if mode == 'x-sendfile':
+        return send_file(filepath, as_attachment=True, download_name=download_name, mimetype=mimetype)
+    if mode == 'x-accel' and os.path.abspath(filepath).startswith(cache_folder + os.sep):
+        # nginx yang mengirim byte (termasuk Range/ETag); worker langsung bebas
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = (app.config['X_ACCEL_PREFIX'].rstrip('/') + '/'
+                                                + os.path.relpath(filepath, cache_folder).replace(os.sep, '/'))
+        response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+        return response
+    
+    stat = os.stat(filepath)
+    etag = f'{stat.st_ino:x}-{stat.st_size:x}-{int(stat.st_mtime):x}'
+    modified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+    response = Response(mimetype=mimetype, direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = modified
+    response.accept_ranges = 'bytes'
+    response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+    response.cache_control.private = True
+    response.cache_control.max_age = 3600
+    
+    if not is_resource_modified(request.environ, etag=etag, last_modified=modified):
+        response.status_code = 304
+        return response
+    
+    start, end = 0, stat.st_size
+    # If-Range yang tidak cocok berarti file sudah berubah: kirim file utuh
+    if request.range and ('HTTP_IF_RANGE' not in request.environ or not is_resource_modified(
+            request.environ, etag=etag, last_modified=modified, ignore_if_range=False)):
+        byte_range = request.range.range_for_length(stat.st_size)
+        if byte_range is None and request.range.units == 'bytes' and not any(
+                Range('bytes', [part]).range_for_length(stat.st_size) for part in request.range.ranges):
+            response.status_code = 416
+            response.headers['Content-Range'] = f'bytes */{stat.st_size}'
+            return response
+        # Beberapa range sekaligus (multipart/byteranges) tidak didukung: kirim file utuh
+        if byte_range:
+            start, end = byte_range
+            response.status_code = 206
+            response.content_range = f'bytes {start}-{end - 1}/{stat.st_size}'
+    
+    file = open(filepath, 'rb')
+    file.seek(start)
+    if 'wsgi.file_wrapper' in request.environ:
+        # gunicorn memakai posisi file dan Content-Length untuk sendfile(), juga untuk Range
+        response.response = request.environ['wsgi.file_wrapper'](file, STREAM_CHUNK_SIZE)
+    else:
+        response.response = read_file_range(file, end - start)
+    response.content_length = end - start
+    return response
+
+class ZipSink(io.RawIOBase):
+    """Write-only, non-seekable target for ZipFile whose output is drained piecewise"""
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def drain(self):
+        """Bytes written since the last drain"""
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def stream_zip(entries):
+    """Yield a stored (uncompressed) ZIP of (path, name) entries without
+    building it on disk or in memory"""
+    sink = ZipSink()
+    # Tanpa seek, zipfile menulis ukuran tiap file di data descriptor setelah isinya
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for path, name in entries:
+            try:
+                source = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            with source, archive.open(zipfile.ZipInfo(
+                    name, time.localtime(os.fstat(source.fileno()).st_mtime)[:6]), 'w', force_zip64=True) as target:
+                while chunk := source.read(STREAM_CHUNK_SIZE):
+                    target.write(chunk)
+                    yield sink.drain()
+    # Sisa header lokal, data descriptor terakhir dan central directory
+    yield sink.drain()
+
+def read_file_range(file, length):
+    """Yield exactly length bytes from the current position of file"""
+    with file:
+        while length > 0:
+            chunk = file.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+@app.route('/api/stream')
+def stream_download():
+    """Transcode straight from the source and send the output while FFmpeg
+    produces it. The bytes are written to the output cache at the same time"""
+    url = request.args.get('url', '')
+    format_key = request.args.get('format', 'mp3_320')
+    
+    if not url:
+        return jsonify({'success': False, 'error': 'URL required'}), 400
+    if not downloader.validate_url(url):
+        return jsonify({'success': False, 'error': 'Invalid URL'}), 400
+    quality = downloader.quality_options.get(format_key)
+    if not quality or quality['ext'] not in STREAMABLE_EXTENSIONS:
+        return jsonify({'success': False, 'error': 'Streaming is only available for MP3, FLAC, OPUS and WAV'}), 400
+    
+    user_ip = get_client_ip()
+    limited = check_client_limits(user_ip)
+    if limited:
+        return limited
+    
+    job_id = generate_job_id()
+    cache_key = download_cache_key(url, format_key)
+    
+    # Hasil yang sudah ada di cache langsung dikirim dari disk
+    artifact = output_cache.get_ready(cache_key)
+    if artifact:
+        store.create_job(job_id, url, format_key, user_ip, PRIORITY_INTERACTIVE, cache_key=cache_key)
+        job = store.get_job(job_id)
+        complete_jobs([job], artifact['path'], artifact['title'], quality['name'])
+        return observe_serve(send_output_file(artifact['path'], artifact['title']), job)
+    
+    if not scheduler.acquire_transcode_slot(app.config['STREAM_SLOT_TIMEOUT']):
+        response = jsonify({'success': False, 'error': 'Server is busy, try again shortly'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    
+    store.create_job(job_id, url, format_key, user_ip, PRIORITY_INTERACTIVE, attached_to=job_id,
+                     cache_key=cache_key, filename='', streaming=True)
+    store.update_build(job_id, status='processing', message='Starting stream...')
+    workdir = os.path.join(app.config['WORK_FOLDER'], job_id)
+    started = time.time()
+    try:
+        process, first_chunk, info, pipeline = downloader.open_stream(url, format_key, job_id)
+    except Exception as e:
+        ERRORS.labels('streaming', type(e).__name__).inc()
+        scheduler.release_transcode_slot()
+        store.update_build(job_id, status='error', progress=0, message=str(e))
+        return jsonify({'success': False, 'error': str(e)}), 502
+    timings = {'first_byte': round(time.time() - started, 3)}
+    title = info.get('title', 'Unknown')
+    state = {'finished': False}
+    
+    def generate():
+        os.makedirs(workdir, exist_ok=True)
+        output_path = os.path.join(workdir, f"output.{quality['ext']}")
+        streamed = 0
+        last_update = time.time()
+        with open(output_path, 'wb') as output:
+            chunk = first_chunk
+            while chunk:
+                output.write(chunk)
+                yield chunk
+                streamed += len(chunk)
+                if time.time() - last_update >= 1:
+                    store.update_build(job_id, message=f'Streaming... {streamed / 1024**2:.1f} MB sent')
+                    last_update = time.time()
+                chunk = process.stdout.read1(STREAM_CHUNK_SIZE)
         
-        # Sanitize the song title to create a valid filename
-        file_extension = os.path.splitext(original_filename)[1]
-        download_name = f"{secure_filename(song_title)}{file_extension}"
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        FFMPEG_CPU.labels(pipeline).inc(reap_process(process))
+        state['finished'] = True
+        if process.returncode != 0:
+            ERRORS.labels('streaming', 'FFmpegError').inc()
+            store.update_build(job_id, status='error', progress=0,
+                               message=f"FFmpeg failed: {stderr.decode(errors='replace').strip()[-500:]}")
+            return
         
-        # Menentukan mimetype secara dinamis
-        mimetype = 'application/octet-stream'
-        mimetypes = {'mp3': 'audio/mpeg', 'flac': 'audio/flac', 'm4a': 'audio/mp4', 'wav': 'audio/wav', 'opus': 'audio/opus', 'mp4': 'video/mp4'}
-        mimetype = mimetypes.get(file_extension.strip('.'), 'application/octet-stream')
-
-        if os.path.exists(filepath):
-            return send_file(filepath, as_attachment=True, download_name=download_name, mimetype=mimetype)
+        timings['stream'] = round(time.time() - started, 3)
+        STAGE_SECONDS.labels('serve', format_key, cache_key.split(':', 1)[0]).observe(timings['stream'])
+        downloader.pipeline_stats[pipeline] += 1
+        while True:
+            artifact = output_cache.claim(cache_key, job_id)
+            if artifact and artifact['status'] == 'ready':
+                output_path = artifact['path']
+                break
+            # Job lain yang masih membangun key ini kalah cepat: file stream ini yang disimpan,
+            # karena workdir dihapus saat koneksi ditutup
+            if artifact is None or output_cache.take_over(cache_key, artifact['job_id'], job_id):
+                output_path = output_cache.store_file(cache_key, job_id, output_path, title)
+                break
+        complete_jobs([store.get_job(job_id)], output_path, title, quality['name'],
+                      timings=timings, pipeline=pipeline)
     
-    return "File not found", 404
+    def close():
+        if not state['finished']:
+            # Klien memutus koneksi sebelum selesai
+            process.kill()
+            process.communicate()
+            store.update_build(job_id, status='cancelled', progress=0, message='Stream closed by client')
+        scheduler.release_transcode_slot()
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    response = Response(generate(), mimetype=MIMETYPES[quality['ext']])
+    response.headers['Content-Disposition'] = f'attachment; filename="{secure_filename(title)}.{quality["ext"]}"'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(close)
+    return response
 
 @app.route('/api/batch-download', methods=['POST'])
 def batch_download():
@@ -413,73 +2827,164 @@ def batch_download():
     if not allowed_file(file.filename):
         return jsonify({'success': False, 'error': 'Invalid file type'})
     
-    # Save uploaded file
-    temp_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file.filename))
-    file.save(temp_path)
+    user_ip = get_client_ip()
+    max_batches = app.config['CLIENT_MAX_BATCHES']
+    if max_batches and store.count_active_batches(user_ip) >= max_batches:
+        return too_many_requests('A batch is already running, wait for it to finish', 30)
+    retry_after = byte_quota_retry_after(user_ip)
+    if retry_after:
+        return too_many_requests('Daily download quota reached', retry_after)
     
-    # Read URLs from file
-    urls = []
-    with open(temp_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and downloader.validate_url(line):
-                urls.append(line)
+    # Daftar URL disimpan ke disk per potongan dan dibaca bertahap oleh BatchFeeder
+    batch_id = generate_job_id()
+    source_path = os.path.join(app.config['UPLOAD_FOLDER'], f'batch-{batch_id}.txt')
+    file.save(source_path)
     
-    # Start batch downloads
-    job_ids = []
-    user_ip = get_client_ip()
+    store.create_batch(batch_id, user_ip, format_key, source_path)
+    batch_feeder.start(batch_id)
     
-    for url in urls[:10]:  # Limit to 10 URLs
-        job_id = generate_job_id()
-        thread = threading.Thread(
-            target=downloader.download_media,
-            args=(url, format_key, job_id, user_ip)
-        )
-        thread.daemon = True
-        thread.start()
-        job_ids.append(job_id)
+    return jsonify({
+        'success': True,
+        'batch_id': batch_id,
+        'message': 'Batch queued'
+    })
+
+@app.route('/api/batch/<batch_id>')
+def get_batch_status(batch_id):
+    """Aggregate status of a batch plus the state of its items.
+    `since` limits items to those changed after a previous response's `now`"""
+    batch = store.get_batch(batch_id)
+    if not batch:
+        return jsonify({'success': False, 'error': 'Batch not found'}), 404
     
-    # Clean up temp file
-    os.remove(temp_path)
+    now = time.time()
+    try:
+        since = float(request.args.get('since', 0))
+    except ValueError:
+        since = 0
+    counts = store.batch_counts(batch_id)
+    active = counts.get('queued', 0) + counts.get('processing', 0)
+    if batch['status'] == 'expanding':
+        status = 'expanding'
+    else:
+        status = 'processing' if active else 'completed'
     
     return jsonify({
         'success': True,
-        'job_ids': job_ids,
-        'count': len(job_ids),
-        'message': f'Started {len(job_ids)} downloads'
+        'batch_id': batch_id,
+        'status': status,
+        'format': batch['format_key'],
+        'total': batch['total'],
+        'counts': counts,
+        'message': batch['message'],
+        'items': [{
+            'job_id': job['job_id'],
+            'url': job['url'],
+            'title': job.get('title'),
+            'status': job['status'],
+            'progress': job['progress'],
+            'message': job['message'],
+        } for job in store.batch_jobs(batch_id, since)],
+        'now': now,
     })
 
+@app.route('/api/batch/<batch_id>/archive')
+def download_batch_archive(batch_id):
+    """All completed files of a batch as one streamed ZIP"""
+    if not store.get_batch(batch_id):
+        return jsonify({'success': False, 'error': 'Batch not found'}), 404
+    
+    entries = []
+    names = set()
+    for job in store.batch_jobs(batch_id):
+        if job['status'] != 'completed' or not job.get('filepath'):
+            continue
+        # Nama file sama seperti download_file; judul kembar diberi nomor
+        stem = secure_filename(job.get('title') or '') or job['job_id']
+        ext = os.path.splitext(job['filepath'])[1]
+        name, number = f'{stem}{ext}', 1
+        while name in names:
+            number += 1
+            name = f'{stem}_{number}{ext}'
+        names.add(name)
+        entries.append((job['filepath'], name))
+    if not entries:
+        return jsonify({'success': False, 'error': 'No completed files in this batch'}), 404
+    
+    response = Response(stream_zip(entries), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="batch-{batch_id[:8]}.zip"'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @app.route('/api/history')
 def get_history():
     """Get download history for current user"""
     user_ip = get_client_ip()
-    user_history = [d for d in download_history if d['user_ip'] == user_ip]
-    return jsonify({'history': user_history[-20:]})
+    return jsonify({'history': store.recent_history(20, user_ip=user_ip)})
 
 @app.route('/api/clear-history', methods=['POST'])
 def clear_history():
     """Clear user's download history"""
     user_ip = get_client_ip()
-    global download_history
     
     # Keep only history from other users
-    download_history = [d for d in download_history if d['user_ip'] != user_ip]
+    store.clear_history(user_ip)
     
     return jsonify({'success': True, 'message': 'History cleared'})
 
+class QueueCollector:
+    """Gauges read from the shared database at scrape time, so every worker reports the same values"""
+
+    def collect(self):
+        now = time.time()
+        jobs = GaugeMetricFamily('downloader_jobs', 'Queued and running jobs', labels=['status', 'priority'])
+        oldest = GaugeMetricFamily('downloader_oldest_queued_seconds', 'Age of the oldest queued job',
+                                   labels=['priority'])
+        for status, priority, count, created_at in store.active_job_counts():
+            jobs.add_metric([status, priority_label(priority)], count)
+            if status == 'queued':
+                oldest.add_metric([priority_label(priority)], now - created_at)
+        yield jobs
+        yield oldest
+        files, size = output_cache.usage()
+        yield GaugeMetricFamily('downloader_output_cache_files', 'Files in the output cache', value=files)
+        yield GaugeMetricFamily('downloader_output_cache_bytes', 'Bytes in the output cache', value=size)
+
+
+queue_registry = CollectorRegistry()
+queue_registry.register(QueueCollector())
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics of all workers"""
+    registry = REGISTRY
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry) + generate_latest(queue_registry),
+                    content_type=CONTENT_TYPE_LATEST)
+
+@app.route('/api/profile/<job_id>')
+def job_profile(job_id):
+    """Top functions of a profiled job by cumulative time"""
+    if not profiling_allowed():
+        return jsonify({'success': False, 'error': 'Profiling is disabled'}), 403
+    path = os.path.join(app.config['PROFILE_FOLDER'], f'{secure_filename(job_id)}.prof')
+    if not os.path.exists(path):
+        return jsonify({'success': False, 'error': 'No profile for this job'}), 404
+    output = io.StringIO()
+    pstats.Stats(path, stream=output).sort_stats('cumulative').print_stats(request.args.get('limit', 50, type=int))
+    return Response(output.getvalue(), mimetype='text/plain')
+
 @app.route('/api/system-status')
 def system_status():
     """Get system status"""
     # Get disk space
-    import shutil
     # Check if FFmpeg is available in the system's PATH
-    ffmpeg_path = shutil.which('ffmpeg')
-    # Fallback untuk lingkungan hosting
-    if not ffmpeg_path and os.path.exists('/usr/bin/ffmpeg'):
-        ffmpeg_path = '/usr/bin/ffmpeg'
-        
-    ffmpeg_available = ffmpeg_path is not None
-    total, used, free = shutil.disk_usage(".")
+    ffmpeg_available = downloader.find_ffmpeg() is not None
+    total, used, free = shutil.disk_usage(app.config['CACHE_FOLDER'])
+    cached_files, cached_bytes = output_cache.usage()
+    staged_files, staged_bytes = prefetcher.usage()
     
     return jsonify({
         'ffmpeg_available': ffmpeg_available,
@@ -489,8 +2994,15 @@ def system_status():
             'free': free,
             'free_gb': free // (2**30)
         },
-        'active_downloads': len([d for d in active_downloads.values() if d['status'] == 'processing']),
-        'total_downloads': len(download_history)
+        'active_downloads': store.count_jobs('processing'),
+        'queued_downloads': store.count_jobs('queued'),
+        'metadata_cache': metadata_cache.stats,
+        'output_cache': dict(output_cache.stats, files=cached_files, bytes=cached_bytes),
+        'prefetch': dict(prefetcher.stats, enabled=prefetcher.enabled, files=staged_files, bytes=staged_bytes),
+        'pipelines': downloader.pipeline_stats,
+        'ydl_pool': ydl_pool.stats,
+        'outbound': governor.stats,
+        'total_downloads': store.count_history()
     })
 
 @app.route('/api/check-dependencies')
@@ -536,9 +3048,7 @@ def server_error(e):
     return render_template('500.html'), 500
 
 if __name__ == '__main__':
-    # Start cleanup thread
-    cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
-    cleanup_thread.start()
+    warm_up()
     
     # Run the app
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
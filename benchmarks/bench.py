@@ -0,0 +1,659 @@
+# benchmarks/bench.py - benchmark dan uji beban offline
+"""Offline benchmark and load test for the downloader.
+
+Generates synthetic audio/video with FFmpeg, serves it from a local HTTP
+server together with a stub yt-dlp extractor (yt_dlp_plugins/), starts the
+app under gunicorn with gunicorn.conf.py and drives these scenarios:
+
+    video_info      POST /api/video-info
+    download        POST /api/download, then poll /api/status until done
+    batch           POST /api/batch-download, then poll /api/batch/<id>
+    download_file   GET /api/download-file/<job_id>
+    expired_url     /api/video-info, revoke the stream URLs, then /api/download;
+                    the job must re-extract instead of failing
+
+Each scenario reports throughput, p50/p99 latency, error count and the CPU
+seconds used per job by the gunicorn processes and their FFmpeg children;
+the run also reports peak RSS. Results are written as JSON and compared to
+a baseline; the exit status is 1 when a metric regressed beyond the
+tolerance.
+
+    python benchmarks/bench.py                    # run, compare with benchmarks/baseline.json
+    python benchmarks/bench.py --save-baseline    # run and store the result as the new baseline
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl
+
+import requests
+from prometheus_client.parser import text_string_to_metric_families
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT_DIR = BENCH_DIR.parent
+SCENARIOS = ('video_info', 'download', 'batch', 'download_file', 'expired_url')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# Metrik yang lebih tinggi lebih baik; sisanya (latensi, CPU, memori) lebih rendah lebih baik
+HIGHER_IS_BETTER = {'throughput'}
+
+
+def generate_media(folder, duration):
+    """Synthetic source files: AAC and Opus audio, H.264 video and a cover image"""
+    commands = {
+        'audio.m4a': ['-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+                      '-c:a', 'aac', '-b:a', '128k'],
+        'audio.webm': ['-f', 'lavfi', '-i', f'sine=frequency=660:duration={duration}',
+                       '-c:a', 'libopus', '-b:a', '96k'],
+        'video.mp4': ['-f', 'lavfi', '-i', f'testsrc2=size=640x360:rate=25:duration={duration}',
+                      '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-an'],
+        'cover.jpg': ['-f', 'lavfi', '-i', 'color=c=steelblue:s=320x320', '-frames:v', '1'],
+    }
+    os.makedirs(folder, exist_ok=True)
+    for name, args in commands.items():
+        subprocess.run(['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', *args, os.path.join(folder, name)],
+                       check=True)
+
+
+def media_info(base_url, folder, video_id, duration, generation):
+    """Info dict returned by the stub extractor for one synthetic video. Stream URLs
+    carry a generation like the signed URLs of real sites; see MediaServer.expire"""
+    def size(name):
+        return os.path.getsize(os.path.join(folder, name))
+
+    def stream_url(name):
+        return f'{base_url}/files/{name}?id={video_id}&gen={generation}'
+
+    return {
+        'id': video_id,
+        'title': f'Bench track {video_id}',
+        'duration': duration,
+        'channel': 'bench',
+        'uploader': 'bench',
+        'view_count': 0,
+        'description': 'Synthetic media for benchmarks',
+        'thumbnail': f'{base_url}/files/cover.jpg',
+        'formats': [
+            {'format_id': 'audio-aac', 'url': stream_url('audio.m4a'), 'ext': 'm4a',
+             'acodec': 'mp4a.40.2', 'vcodec': 'none', 'abr': 128, 'filesize': size('audio.m4a')},
+            {'format_id': 'audio-opus', 'url': stream_url('audio.webm'), 'ext': 'webm',
+             'acodec': 'opus', 'vcodec': 'none', 'abr': 96, 'filesize': size('audio.webm')},
+            {'format_id': 'video-360', 'url': stream_url('video.mp4'), 'ext': 'mp4',
+             'vcodec': 'avc1.42c01e', 'acodec': 'none', 'width': 640, 'height': 360, 'fps': 25,
+             'filesize': size('video.mp4')},
+        ],
+    }
+
+
+class MediaServer:
+    """Local stand-in for a media site: info JSON for the stub extractor plus ranged file downloads"""
+
+    def __init__(self, folder, duration, extract_latency):
+        self.folder = folder
+        self.generations = {}  # video_id -> generation of its valid stream URLs
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_HEAD(self):
+                self.serve(body=False)
+
+            def do_GET(self):
+                self.serve(body=True)
+
+            def serve(self, body):
+                match = re.fullmatch(r'/info/([\w-]+)\.json', self.path)
+                if match:
+                    # Meniru waktu ekstraksi di situs asli
+                    time.sleep(extract_latency)
+                    video_id = match.group(1)
+                    data = json.dumps(media_info(server.base_url, folder, video_id, duration,
+                                                 server.generations.get(video_id, 0))).encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    if body:
+                        self.wfile.write(data)
+                    return
+                path, _, query = self.path.partition('?')
+                match = re.fullmatch(r'/files/([\w.-]+)', path)
+                path = os.path.join(folder, match.group(1)) if match else None
+                if not path or not os.path.isfile(path):
+                    self.send_error(404)
+                    return
+                stream = dict(parse_qsl(query))
+                if int(stream.get('gen', 0)) < server.generations.get(stream.get('id'), 0):
+                    # URL lama yang sudah dicabut, seperti URL bertanda tangan yang kedaluwarsa
+                    self.send_error(403)
+                    return
+                server.send_file(self, path, body)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self.httpd.server_port}'
+
+    @staticmethod
+    def send_file(handler, path, body):
+        size = os.path.getsize(path)
+        start, end = 0, size
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', handler.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+            else:
+                start = max(0, size - int(match.group(2)))
+            handler.send_response(206)
+            handler.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+        else:
+            handler.send_response(200)
+        handler.send_header('Accept-Ranges', 'bytes')
+        handler.send_header('Content-Length', str(end - start))
+        handler.send_header('Content-Type', 'application/octet-stream')
+        handler.end_headers()
+        if not body:
+            return
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(remaining, 256 * 1024))
+                if not chunk:
+                    break
+                handler.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def expire(self, video_id):
+        """Revoke the stream URLs handed out so far for video_id"""
+        self.generations[video_id] = self.generations.get(video_id, 0) + 1
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class AppServer:
+    """The app under gunicorn, configured like production but isolated in a scratch folder"""
+
+    def __init__(self, workdir, workers, threads, extra_env):
+        self.port = free_port()
+        self.base_url = f'http://127.0.0.1:{self.port}'
+        self.workdir = workdir
+        self.env = dict(os.environ)
+        self.env.update({
+            'PORT': str(self.port),
+            'GUNICORN_WORKERS': str(workers),
+            'GUNICORN_THREADS': str(threads),
+            'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+            'CACHE_FOLDER': os.path.join(workdir, 'cache'),
+            'WORK_FOLDER': os.path.join(workdir, 'work'),
+            'PREFETCH_FOLDER': os.path.join(workdir, 'prefetch'),
+            'PROFILE_FOLDER': os.path.join(workdir, 'profiles'),
+            'PROMETHEUS_MULTIPROC_DIR': os.path.join(workdir, 'metrics'),
+            # UPLOAD_FOLDER (file batch) dan folder sementara lainnya mengikuti TMPDIR
+            'TMPDIR': os.path.join(workdir, 'tmp'),
+            # Semua permintaan datang dari satu mesin; batas per klien tidak diukur di sini
+            'CLIENT_MAX_ACTIVE_JOBS': '0',
+            'CLIENT_JOBS_PER_MINUTE': '0',
+            'CLIENT_MAX_BATCHES': '0',
+            'CLIENT_DAILY_BYTES': '0',
+            # Folder benchmarks/ di PYTHONPATH supaya yt-dlp memuat extractor pengganti
+            'PYTHONPATH': os.pathsep.join(filter(None, [str(BENCH_DIR), os.environ.get('PYTHONPATH')])),
+        })
+        self.env.update(extra_env)
+        self.process = None
+
+    def start(self):
+        os.makedirs(self.env['TMPDIR'], exist_ok=True)
+        self.log = open(os.path.join(self.workdir, 'gunicorn.log'), 'wb')
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+            cwd=ROOT_DIR, env=self.env, stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"gunicorn exited, see {self.log.name}")
+            try:
+                if requests.get(f'{self.base_url}/api/check-dependencies', timeout=2).ok:
+                    return
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError('gunicorn did not start within 60 seconds')
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self.process:
+            self.log.close()
+
+    def pids(self):
+        """gunicorn master, its workers and their FFmpeg children"""
+        parents = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open(f'/proc/{entry}/stat') as f:
+                        parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+        tree = [self.process.pid]
+        for pid in tree:
+            tree.extend(child for child, parent in parents.items() if parent == pid)
+        return tree
+
+    def cpu_seconds(self):
+        """CPU time of the master and workers, including reaped children (FFmpeg)"""
+        total = 0
+        for pid in self.pids():
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            # utime, stime, cutime, cstime
+            total += sum(int(value) for value in fields[11:15])
+        return total / CLOCK_TICKS
+
+    def rss_bytes(self):
+        total = 0
+        for pid in self.pids():
+            try:
+                with open(f'/proc/{pid}/statm') as f:
+                    total += int(f.read().split()[1]) * PAGE_SIZE
+            except OSError:
+                continue
+        return total
+
+    def stage_timings(self):
+        """Mean seconds per stage from the app's /metrics histograms"""
+        sums, counts = {}, {}
+        text = requests.get(f'{self.base_url}/metrics', timeout=10).text
+        for family in text_string_to_metric_families(text):
+            if family.name != 'downloader_stage_seconds':
+                continue
+            for sample in family.samples:
+                stage = sample.labels.get('stage')
+                if sample.name.endswith('_sum'):
+                    sums[stage] = sums.get(stage, 0) + sample.value
+                elif sample.name.endswith('_count'):
+                    counts[stage] = counts.get(stage, 0) + sample.value
+        return {stage: round(sums[stage] / counts[stage], 4) for stage in sums if counts.get(stage)}
+
+
+class MemorySampler:
+    """Samples the RSS of the whole gunicorn process tree and keeps the peak"""
+
+    def __init__(self, app_server, interval=0.2):
+        self.app_server = app_server
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.app_server.rss_bytes())
+            self._stop.wait(self.interval)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class Runner:
+    def __init__(self, args, app_server, media_server):
+        self.args = args
+        self.app = app_server
+        self.media = media_server
+        self.completed_jobs = []
+
+    def video_url(self, video_id=None):
+        # ID baru berarti kunci cache baru: unduhan benar-benar dikerjakan
+        return f'{self.media.base_url}/bench/{video_id or uuid.uuid4().hex[:12]}'
+
+    def headers(self, user):
+        # Setiap pengguna virtual tampil sebagai klien berbeda
+        return {'X-Forwarded-For': f'10.0.{user // 256}.{user % 256}'}
+
+    def run(self, name):
+        scenario = getattr(self, f'scenario_{name}')
+        cpu_before = self.app.cpu_seconds()
+        started = time.perf_counter()
+        latencies, errors, jobs = scenario()
+        elapsed = time.perf_counter() - started
+        cpu = self.app.cpu_seconds() - cpu_before
+        done = len(latencies)
+        return {
+            'requests': done + errors,
+            'errors': errors,
+            'jobs': jobs,
+            'seconds': round(elapsed, 3),
+            'throughput': round(done / elapsed, 3) if elapsed else 0,
+            'p50': round(percentile(latencies, 0.50), 4) if latencies else None,
+            'p99': round(percentile(latencies, 0.99), 4) if latencies else None,
+            'max': round(max(latencies), 4) if latencies else None,
+            'cpu_seconds': round(cpu, 3),
+            'cpu_per_job': round(cpu / jobs, 4) if jobs else None,
+        }
+
+    def load(self, count, func):
+        """Call func(index, session) count times from `concurrency` virtual users"""
+        latencies, errors = [], 0
+        lock = threading.Lock()
+        counter = iter(range(count))
+
+        def user(number):
+            nonlocal errors
+            session = requests.Session()
+            session.headers.update(self.headers(number))
+            for index in counter:
+                started = time.perf_counter()
+                try:
+                    ok = func(index, session)
+                except requests.RequestException:
+                    ok = False
+                with lock:
+                    if ok:
+                        latencies.append(time.perf_counter() - started)
+                    else:
+                        errors += 1
+
+        with ThreadPoolExecutor(self.args.concurrency) as pool:
+            for number in range(self.args.concurrency):
+                pool.submit(user, number)
+        return latencies, errors
+
+    def wait_for_job(self, session, job_id):
+        """Poll /api/status like the web UI until the job finishes; True when it completed"""
+        deadline = time.time() + self.args.job_timeout
+        while time.time() < deadline:
+            status = session.get(f'{self.app.base_url}/api/status/{job_id}', timeout=30).json()['status']
+            if status == 'completed':
+                return True
+            if status in ('error', 'cancelled', 'not_found'):
+                return False
+            time.sleep(self.args.poll_interval)
+        return False
+
+    def scenario_video_info(self):
+        # Sebagian URL diulang supaya cache metadata ikut terukur
+        unique = max(1, int(self.args.requests * (1 - self.args.repeat_ratio)))
+        ids = [uuid.uuid4().hex[:12] for _ in range(unique)]
+
+        def request_info(index, session):
+            response = session.post(f'{self.app.base_url}/api/video-info',
+                                    json={'url': self.video_url(ids[index % unique])}, timeout=60)
+            return response.ok and response.json().get('success')
+
+        latencies, errors = self.load(self.args.requests, request_info)
+        return latencies, errors, unique
+
+    def scenario_download(self):
+        formats = self.args.formats.split(',')
+
+        def download(index, session):
+            response = session.post(f'{self.app.base_url}/api/download', timeout=30, json={
+                'url': self.video_url(), 'format': formats[index % len(formats)]})
+            job_id = response.json().get('job_id') if response.ok else None
+            if not job_id or not self.wait_for_job(session, job_id):
+                return False
+            self.completed_jobs.append(job_id)
+            return True
+
+        latencies, errors = self.load(self.args.jobs, download)
+        return latencies, errors, len(latencies)
+
+    def scenario_batch(self):
+        latencies, errors, jobs = [], 0, 0
+        session = requests.Session()
+        session.headers.update(self.headers(0))
+        for _ in range(self.args.batches):
+            urls = '\n'.join(self.video_url() for _ in range(self.args.batch_size))
+            started = time.perf_counter()
+            response = session.post(f'{self.app.base_url}/api/batch-download', timeout=30,
+                                    data={'format': self.args.formats.split(',')[0]},
+                                    files={'file': ('bench.txt', urls.encode())})
+            batch_id = response.json().get('batch_id') if response.ok else None
+            batch = {}
+            deadline = time.time() + self.args.job_timeout * self.args.batch_size
+            while batch_id and time.time() < deadline:
+                batch = session.get(f'{self.app.base_url}/api/batch/{batch_id}', timeout=30).json()
+                if batch.get('status') == 'completed':
+                    break
+                time.sleep(self.args.poll_interval * 5)
+            completed = batch.get('counts', {}).get('completed', 0)
+            jobs += completed
+            if batch.get('status') == 'completed' and completed == self.args.batch_size:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+        return latencies, errors, jobs
+
+    def scenario_download_file(self):
+        if not self.completed_jobs:
+            return [], 0, 0
+
+        def fetch(index, session):
+            job_id = self.completed_jobs[index % len(self.completed_jobs)]
+            with session.get(f'{self.app.base_url}/api/download-file/{job_id}', stream=True, timeout=60) as response:
+                if not response.ok:
+                    return False
+                for _ in response.iter_content(256 * 1024):
+                    pass
+            return True
+
+        latencies, errors = self.load(self.args.requests, fetch)
+        return latencies, errors, len(latencies)
+
+    def scenario_expired_url(self):
+        formats = self.args.formats.split(',')
+
+        def download(index, session):
+            video_id = uuid.uuid4().hex[:12]
+            response = session.post(f'{self.app.base_url}/api/video-info', timeout=60,
+                                    json={'url': self.video_url(video_id)})
+            if not (response.ok and response.json().get('success')):
+                return False
+            # Info sudah di cache app; URL stream di dalamnya kini ditolak sumber
+            self.media.expire(video_id)
+            response = session.post(f'{self.app.base_url}/api/download', timeout=30, json={
+                'url': self.video_url(video_id), 'format': formats[index % len(formats)]})
+            job_id = response.json().get('job_id') if response.ok else None
+            return bool(job_id) and self.wait_for_job(session, job_id)
+
+        latencies, errors = self.load(max(1, self.args.jobs // 4), download)
+        return latencies, errors, len(latencies)
+
+
+def compare(results, baseline, tolerance):
+    """Metrics that got worse than the baseline by more than `tolerance` (a fraction)"""
+    regressions = []
+    checked = ('throughput', 'p50', 'p99', 'cpu_per_job')
+    for name, current in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        if current['errors'] > before.get('errors', 0):
+            regressions.append(f"{name}.errors: {before.get('errors', 0)} -> {current['errors']}")
+        for metric in checked:
+            old, new = before.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            if worse > tolerance:
+                regressions.append(f'{name}.{metric}: {old} -> {new} ({change:+.0%})')
+    old_rss, new_rss = baseline.get('peak_rss_mb'), results.get('peak_rss_mb')
+    if old_rss and new_rss and (new_rss - old_rss) / old_rss > tolerance:
+        regressions.append(f'peak_rss_mb: {old_rss} -> {new_rss} ({(new_rss - old_rss) / old_rss:+.0%})')
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(f"\n{'scenario':<15}{'reqs':>6}{'errs':>6}{'thrpt/s':>10}{'p50 s':>9}{'p99 s':>9}{'cpu/job s':>11}")
+    for name, row in results['scenarios'].items():
+        cells = [row[key] if row[key] is not None else '-' for key in ('p50', 'p99', 'cpu_per_job')]
+        print(f"{name:<15}{row['requests']:>6}{row['errors']:>6}{row['throughput']:>10}"
+              f"{cells[0]:>9}{cells[1]:>9}{cells[2]:>11}")
+    print(f"peak RSS: {results['peak_rss_mb']} MB")
+    if results.get('stage_seconds'):
+        print('mean stage seconds: ' + ', '.join(f'{k}={v}' for k, v in sorted(results['stage_seconds'].items())))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline benchmark and load test')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated subset of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=8, help='virtual users per scenario')
+    parser.add_argument('--requests', type=int, default=200, help='requests for video_info and download_file')
+    parser.add_argument('--jobs', type=int, default=24, help='downloads in the download scenario (a quarter of that in expired_url)')
+    parser.add_argument('--batches', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--formats', default='mp3_192,m4a,opus,mp4_360',
+                        help='format keys cycled through by the download scenario')
+    parser.add_argument('--repeat-ratio', type=float, default=0.5,
+                        help='share of video_info requests for an already requested URL')
+    parser.add_argument('--media-seconds', type=int, default=30, help='length of the synthetic media')
+    parser.add_argument('--extract-latency', type=float, default=0.05,
+                        help='seconds the stub site takes to answer an info request')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=16, help='gunicorn threads per worker')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='extra environment for the app, e.g. FETCH_WORKERS=8')
+    parser.add_argument('--poll-interval', type=float, default=0.1)
+    parser.add_argument('--job-timeout', type=float, default=120)
+    parser.add_argument('--output', help='result file (default: benchmarks/results/<timestamp>.json)')
+    parser.add_argument('--baseline', default=str(BENCH_DIR / 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative regression before the run fails')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch folder')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+    if not shutil.which('ffmpeg'):
+        sys.exit('ffmpeg is required')
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    media = MediaServer(os.path.join(workdir, 'media'), args.media_seconds, args.extract_latency)
+    app = AppServer(workdir, args.workers, args.threads, dict(item.split('=', 1) for item in args.env))
+    try:
+        print(f'generating {args.media_seconds}s of synthetic media in {workdir}')
+        generate_media(media.folder, args.media_seconds)
+        media.start()
+        app.start()
+        runner = Runner(args, app, media)
+        results = {'scenarios': {}}
+        with MemorySampler(app) as memory:
+            for name in scenarios:
+                print(f'running {name}...')
+                results['scenarios'][name] = runner.run(name)
+        results['peak_rss_mb'] = round(memory.peak / 1024**2, 1)
+        results['stage_seconds'] = app.stage_timings()
+    finally:
+        app.stop()
+        media.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # Konfigurasi ikut disimpan: hasil hanya sebanding dengan run yang setara
+    results.update({
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'host': {'python': platform.python_version(), 'platform': platform.platform(),
+                 'cpus': os.cpu_count()},
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('output', 'baseline', 'save_baseline', 'keep', 'tolerance')},
+    })
+    print_results(results)
+
+    output = Path(args.output or BENCH_DIR / 'results' / f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2) + '\n')
+    print(f'results written to {output}')
+
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(results, indent=2) + '\n')
+        print(f'baseline saved to {baseline_path}')
+        return 0
+    if not baseline_path.exists():
+        print('no baseline to compare with (use --save-baseline)')
+        return 0
+
+    baseline = json.loads(baseline_path.read_text())
+    if baseline.get('config') != results['config']:
+        print('warning: baseline was recorded with a different configuration')
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f'regressions beyond {args.tolerance:.0%}:')
+        for line in regressions:
+            print(f'  {line}')
+        return 1
+    print(f'no regressions beyond {args.tolerance:.0%} compared with {baseline_path}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,12 @@
+# Extractor pengganti untuk benchmark: info video dibaca dari server media lokal benchmarks/bench.py.
+# yt-dlp memuatnya sebagai plugin bila folder benchmarks/ ada di PYTHONPATH
+from yt_dlp.extractor.common import InfoExtractor
+
+
+class BenchStubIE(InfoExtractor):
+    IE_NAME = 'benchstub'
+    _VALID_URL = r'https?://(?:127\.0\.0\.1|localhost):(?P<port>\d+)/bench/(?P<id>[\w-]+)'
+
+    def _real_extract(self, url):
+        video_id, port = self._match_valid_url(url).group('id', 'port')
+        return self._download_json(f'http://127.0.0.1:{port}/info/{video_id}.json', video_id)
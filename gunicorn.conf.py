@@ -0,0 +1,49 @@
+# gunicorn.conf.py - dibaca otomatis oleh `gunicorn app:app`
+import os
+import shutil
+import tempfile
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+
+# gthread: koneksi event stream (SSE) yang panjang tidak memblokir seluruh worker, tapi tiap
+# koneksi memakai satu thread. Jaga threads > EVENT_STREAM_MAX_CONNECTIONS (batas SSE per worker)
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+# Metrik Prometheus tiap worker ditulis ke folder ini lalu digabung saat /metrics dibaca.
+# Harus diset sebelum app (dan prometheus_client) dimuat
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                      os.path.join(tempfile.gettempdir(), 'prometheus-metrics'))
+
+# Aplikasi (yt-dlp, extractor, SQLAlchemy) dimuat sekali di master lalu di-fork,
+# sehingga worker baru langsung siap dan memorinya dibagi copy-on-write
+preload_app = True
+
+
+def on_starting(server):
+    # Sisa metrik dari proses sebelumnya tidak boleh ikut dihitung
+    shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+
+def when_ready(server):
+    from app import warm_up
+    warm_up()
+
+
+def post_fork(server, worker):
+    from app import after_fork
+    after_fork()
+
+
+def worker_exit(server, worker):
+    from app import before_exit
+    before_exit()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)